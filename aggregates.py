@@ -0,0 +1,78 @@
+import batch
+import constants
+
+# Cargo aggregates kept on each boat: load_count and total_volume. They are
+# changed in the same transaction as the assignment, removal or volume change
+# that affects them; rebuild recomputes them from the loads.
+
+
+# A load's volume as a number, volumes that are not numbers count as 0
+def volume(load):
+    value = load.get("volume")
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return 0
+    return value
+
+
+def add(boat, load):
+    boat["load_count"] = boat.get("load_count", 0) + 1
+    boat["total_volume"] = boat.get("total_volume", 0) + volume(load)
+
+
+def remove(boat, load):
+    boat["load_count"] = max(boat.get("load_count", 0) - 1, 0)
+    boat["total_volume"] = boat.get("total_volume", 0) - volume(load)
+
+
+def change_volume(boat, old_volume, new_volume):
+    boat["total_volume"] = boat.get("total_volume", 0) - old_volume + new_volume
+
+
+# Carry a change to a load's volume, or to the boat carrying it, over to the
+# aggregates of the boats that carried and now carry it, inside the caller's
+# transaction. Returns the boats updated.
+def update_carrier(client, load, old_volume, old_carrier):
+    old_id = int(old_carrier["id"]) if old_carrier else None
+    new_id = int(load["carrier"]["id"]) if load.get("carrier") else None
+    if old_id == new_id and (old_id is None or volume(load) == old_volume):
+        return []
+    ids = set(i for i in (old_id, new_id) if i is not None)
+    boats = {boat.key.id: boat for boat in client.get_multi([client.key(constants.boats, i) for i in ids])}
+    if old_id == new_id:
+        if old_id in boats:
+            change_volume(boats[old_id], old_volume, volume(load))
+    else:
+        if old_id in boats:
+            boats[old_id]["load_count"] = max(boats[old_id].get("load_count", 0) - 1, 0)
+            boats[old_id]["total_volume"] = boats[old_id].get("total_volume", 0) - old_volume
+        if new_id in boats:
+            add(boats[new_id], load)
+    client.put_multi(list(boats.values()))
+    return list(boats.values())
+
+
+def summary(boat):
+    return {"load_count": boat.get("load_count", 0), "total_volume": boat.get("total_volume", 0)}
+
+
+# Recompute the aggregates of every boat from the loads, returning the
+# number of boats updated
+def rebuild(client):
+    totals = {}
+    for load in client.query(kind=constants.loads).fetch():
+        carrier = load.get("carrier")
+        if carrier:
+            count, total = totals.get(carrier["id"], (0, 0))
+            totals[carrier["id"]] = (count + 1, total + volume(load))
+    query = client.query(kind=constants.boats)
+    query.keys_only()
+    keys = [boat.key for boat in query.fetch()]
+    updated = 0
+    for chunk in batch.chunks(keys):
+        with client.transaction():
+            boats = client.get_multi(chunk)
+            for boat in boats:
+                boat["load_count"], boat["total_volume"] = totals.get(boat.key.id, (0, 0))
+            client.put_multi(boats)
+        updated += len(boats)
+    return updated
@@ -1,14 +1,28 @@
 import json
+import hashlib
+import threading
+import time
+from collections import OrderedDict
 from urllib.request import urlopen
-from jose import jwt
-import json
+from jose import jwt, jwk
 from dotenv import load_dotenv
 import os
+import metrics
 
 load_dotenv()
 DOMAIN = 'cs493-clarkeab.us.auth0.com'
 ALGORITHMS = ["RS256"]
 CLIENT_ID = os.getenv("client_id")
+ISSUER = "https://" + DOMAIN + "/"
+# the JWKS location can be overridden so a local stand-in server can be used
+JWKS_URL = os.getenv("jwks_url", "https://" + DOMAIN + "/.well-known/jwks.json")
+# seconds fetched keys are used before a background refresh is started
+JWKS_TTL = int(os.getenv("jwks_ttl", "3600"))
+# minimum seconds between blocking refetches caused by an unknown kid
+JWKS_REFETCH_INTERVAL = int(os.getenv("jwks_refetch_interval", "60"))
+JWKS_TIMEOUT = 5
+# number of verified tokens remembered per instance, 0 disables the cache
+TOKEN_CACHE_SIZE = int(os.getenv("token_cache_size", "1024"))
 
 
 # This code is adapted from https://auth0.com/docs/quickstart/backend/python/01-authorization?_ga=2.46956069.349333901.1589042886-466012638.1589042885#create-the-jwt-validation-decorator
@@ -20,8 +34,166 @@ class AuthError(Exception):
         self.status_code = status_code
 
 
+# Process-wide store of the signing keys published at JWKS_URL, indexed by kid
+class JWKSKeyStore:
+    def __init__(self, url, ttl=JWKS_TTL, refetch_interval=JWKS_REFETCH_INTERVAL):
+        self.url = url
+        self.ttl = ttl
+        self.refetch_interval = refetch_interval
+        self._keys = {}
+        self._fetched_at = None
+        self._last_attempt = None
+        self._refreshing = False
+        self._lock = threading.Lock()
+        self._fetch_lock = threading.Lock()
+
+    def _fetch(self):
+        start = time.perf_counter()
+        try:
+            jsonurl = urlopen(self.url, timeout=JWKS_TIMEOUT)
+            jwks = json.loads(jsonurl.read())
+        except Exception:
+            metrics.observe_jwks_fetch(time.perf_counter() - start, False)
+            raise
+        metrics.observe_jwks_fetch(time.perf_counter() - start, True)
+        keys = {}
+        for key in jwks["keys"]:
+            if key.get("kty") != "RSA" or "kid" not in key:
+                continue
+            rsa_key = {
+                "kty": key["kty"],
+                "kid": key["kid"],
+                "use": key.get("use", "sig"),
+                "n": key["n"],
+                "e": key["e"]
+            }
+            # build the RSA key object once instead of on every decode
+            keys[key["kid"]] = jwk.construct(rsa_key, ALGORITHMS[0])
+        return keys
+
+    # fetch the key set, keeping the current (possibly stale) keys on failure
+    def refresh(self):
+        try:
+            keys = self._fetch()
+        except Exception:
+            return False
+        with self._lock:
+            self._keys = keys
+            self._fetched_at = time.monotonic()
+        return True
+
+    # refresh stale keys without blocking the request; a failed refresh is
+    # retried no sooner than refetch_interval later, like _refetch
+    def _refresh_in_background(self):
+        with self._lock:
+            now = time.monotonic()
+            if self._refreshing or (self._last_attempt is not None and now - self._last_attempt < self.refetch_interval):
+                return
+            self._refreshing = True
+            self._last_attempt = now
+
+        def run():
+            try:
+                self.refresh()
+            finally:
+                with self._lock:
+                    self._refreshing = False
+        threading.Thread(target=run, daemon=True).start()
+
+    # blocking refetch, allowed at most once per refetch_interval so tokens
+    # with made-up kids (or an unreachable JWKS endpoint) can't cause a storm
+    def _refetch(self):
+        with self._fetch_lock:
+            now = time.monotonic()
+            if self._last_attempt is not None and now - self._last_attempt < self.refetch_interval:
+                return
+            self._last_attempt = now
+            self.refresh()
+
+    def get_key(self, kid):
+        fetched_at = self._fetched_at
+        if fetched_at is not None and time.monotonic() - fetched_at > self.ttl:
+            self._refresh_in_background()
+        key = self._keys.get(kid)
+        if key is None:
+            self._refetch()
+            key = self._keys.get(kid)
+        return key
+
+    def clear(self):
+        with self._lock:
+            self._keys = {}
+            self._fetched_at = None
+            self._last_attempt = None
+
+
+# Bounded LRU of verified payloads keyed by a digest of the token, so a
+# token that is sent repeatedly only pays for signature verification once
+class TokenCache:
+    def __init__(self, maxsize=TOKEN_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    # the audience and issuer are part of the digest so a payload verified
+    # under one configuration is never served under another
+    def _digest(self, token, audience, issuer):
+        data = "\0".join((str(audience), str(issuer), token))
+        return hashlib.sha256(data.encode("utf-8")).digest()
+
+    def get(self, token, audience, issuer):
+        if self.maxsize <= 0:
+            return None
+        digest = self._digest(token, audience, issuer)
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry is not None and entry[0] > time.time():
+                self._entries.move_to_end(digest)
+                self.hits += 1
+                return dict(entry[1])
+            if entry is not None:
+                del self._entries[digest]
+            self.misses += 1
+        return None
+
+    def set(self, token, audience, issuer, payload):
+        # only tokens with an expiry are cached, and only until that expiry
+        exp = payload.get("exp")
+        if self.maxsize <= 0 or not isinstance(exp, (int, float)):
+            return
+        digest = self._digest(token, audience, issuer)
+        with self._lock:
+            self._entries[digest] = (exp, dict(payload))
+            self._entries.move_to_end(digest)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {"size": len(self._entries), "hits": self.hits, "misses": self.misses,
+                    "hit_ratio": self.hits / lookups if lookups else 0.0}
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+jwks = JWKSKeyStore(JWKS_URL)
+token_cache = TokenCache()
+
+
 # Verify the JWT in the request's Authorization header
 def verify_jwt(request):
+    with metrics.timer("auth"):
+        return _verify_jwt(request)
+
+
+def _verify_jwt(request):
     if 'Authorization' in request.headers:
         auth_header = request.headers['Authorization'].split()
         token = auth_header[1]
@@ -29,9 +201,11 @@ def verify_jwt(request):
         raise AuthError({"code": "no auth header",
                             "description":
                                 "Authorization header is missing"}, 401)
-    
-    jsonurl = urlopen("https://"+ DOMAIN+"/.well-known/jwks.json")
-    jwks = json.loads(jsonurl.read())
+    # skip header parsing, key lookup and signature check for known tokens
+    payload = token_cache.get(token, CLIENT_ID, ISSUER)
+    if payload is not None:
+        return payload
+
     try:
         unverified_header = jwt.get_unverified_header(token)
     except jwt.JWTError:
@@ -44,24 +218,15 @@ def verify_jwt(request):
                         "description":
                             "Invalid header. "
                             "Use an RS256 signed JWT Access Token"}, 401)
-    rsa_key = {}
-    for key in jwks["keys"]:
-        if key["kid"] == unverified_header["kid"]:
-            rsa_key = {
-                "kty": key["kty"],
-                "kid": key["kid"],
-                "use": key["use"],
-                "n": key["n"],
-                "e": key["e"]
-            }
-    if rsa_key:
+    rsa_key = jwks.get_key(unverified_header.get("kid"))
+    if rsa_key is not None:
         try:
             payload = jwt.decode(
                 token,
                 rsa_key,
                 algorithms=ALGORITHMS,
                 audience=CLIENT_ID,
-                issuer="https://"+ DOMAIN+"/"
+                issuer=ISSUER
             )
         except jwt.ExpiredSignatureError:
             raise AuthError({"code": "token_expired",
@@ -76,7 +241,7 @@ def verify_jwt(request):
                             "description":
                                 "Unable to parse authentication"
                                 " token."}, 401)
-
+        token_cache.set(token, CLIENT_ID, ISSUER, payload)
         return payload
     else:
         raise AuthError({"code": "no_rsa_key",
@@ -0,0 +1,103 @@
+import aggregates
+import cache
+import constants
+
+# Helpers that split multi-entity reads and writes into chunks the Datastore
+# API accepts. Inside a transaction the chunks still end up in one commit,
+# which holds at most 500 mutations, so transactional callers split their
+# work with chunks(..., constants.transaction_batch_size) first.
+
+
+class BatchError(Exception):
+    def __init__(self, message):
+        self.message = message
+
+
+# Read the ids of a :batch request from ?ids=1,2,3 or a JSON body of the form
+# {"ids": [1, 2, 3]}. Malformed ids are returned as None, in request order.
+def parse_ids(request):
+    if 'ids' in request.args:
+        raw = [i for i in request.args['ids'].split(',') if i]
+    else:
+        content = request.get_json(silent=True)
+        if not isinstance(content, dict) or not isinstance(content.get("ids"), list):
+            raise BatchError("The request must list the ids to use")
+        raw = content["ids"]
+    if len(raw) > constants.max_batch_items:
+        raise BatchError("At most " + str(constants.max_batch_items) + " ids may be given")
+    ids = []
+    for value in raw:
+        try:
+            value = int(value)
+        except (TypeError, ValueError):
+            value = None
+        ids.append(value if value and value > 0 else None)
+    return ids
+
+
+# Per-item results for ids, with an error already filled in for malformed ids
+def id_results(ids):
+    return [{"status": 400, "Error": "Invalid id"} if i is None else None for i in ids]
+
+
+def chunks(items, size=constants.batch_size):
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+# Entities that do not exist are left out of the result. Outside a
+# transaction the entity cache is consulted first.
+def get_multi(client, keys):
+    found = []
+    for chunk in chunks(keys):
+        found.extend(cache.get_multi(client, chunk))
+    return found
+
+
+def put_multi(client, entities):
+    for chunk in chunks(entities):
+        client.put_multi(chunk)
+
+
+def delete_multi(client, keys):
+    for chunk in chunks(keys):
+        client.delete_multi(chunk)
+
+
+# Keys of the loads carried by each of boat_ids, by boat id. The loads'
+# carrier is the source of truth for which boat carries them, so this is one
+# keys-only query per boat.
+def carried_keys(client, boat_ids):
+    carried = {}
+    for boat_id in boat_ids:
+        query = client.query(kind=constants.loads)
+        query.add_filter("carrier.id", "=", int(boat_id))
+        query.keys_only()
+        carried[int(boat_id)] = [e.key for e in query.fetch()]
+    return carried
+
+
+# Clear the carrier of the loads with load_keys that are still carried by one
+# of boat_ids, skipping loads that no longer exist or have moved
+def detach_loads(client, load_keys, boat_ids):
+    loads = [l for l in get_multi(client, load_keys) if l.get("carrier") and l["carrier"]["id"] in boat_ids]
+    for load in loads:
+        load["carrier"] = None
+    put_multi(client, loads)
+    return loads
+
+
+# Take each of loads off its carrier's aggregates, skipping boats that no longer exist
+def remove_from_carriers(client, loads):
+    by_boat = {}
+    for load in loads:
+        if load.get("carrier"):
+            by_boat.setdefault(int(load["carrier"]["id"]), []).append(load)
+    keys = [client.key(constants.boats, boat_id) for boat_id in by_boat]
+    boats = get_multi(client, keys)
+    for boat in boats:
+        for load in by_boat[boat.key.id]:
+            aggregates.remove(boat, load)
+    put_multi(client, boats)
+    return boats
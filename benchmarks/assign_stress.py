@@ -0,0 +1,113 @@
+# Concurrency stress test for PUT/DELETE /boats/<bid>/loads/<lid>. Threads
+# assign and unassign random loads on a few boats, then every boat's
+# load_count and total_volume are checked against the loads' carriers, so a
+# lost update shows up as a mismatch. Also races every thread to put the same
+# load on a different boat, where exactly one may succeed.
+#   python benchmarks/assign_stress.py [threads] [operations_per_thread]
+# Runs against the Datastore emulator when DATASTORE_EMULATOR_HOST is set,
+# otherwise against the in-memory fake in fake_datastore.py.
+import json
+import random
+import sys
+import threading
+import time
+
+import harness
+
+BOATS = 4
+LOADS = 40
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def check(client, constants, boat_ids):
+    errors = []
+    loads = {l.key.id: l for l in client.query(kind=constants.loads).fetch()}
+    for boat_id in boat_ids:
+        boat = client.get(client.key(constants.boats, boat_id))
+        carried = [l for l in loads.values() if l["carrier"] and l["carrier"]["id"] == boat_id]
+        if boat.get("load_count") != len(carried):
+            errors.append("boat %d load_count %s, carries %d" % (boat_id, boat.get("load_count"), len(carried)))
+        if boat.get("total_volume") != sum(l["volume"] for l in carried):
+            errors.append("boat %d total_volume %s" % (boat_id, boat.get("total_volume")))
+    return errors
+
+
+def main():
+    threads = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    operations = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    issuer = harness.Issuer()
+    harness.use_issuer(issuer)
+    marina, client, fake = harness.start_app()
+    import constants
+    headers = issuer.headers("bench|user")
+    app = marina.app.test_client()
+    boat_ids = [json.loads(app.post("/boats", headers=headers, json={"name": "boat %d" % i, "type": "t", "length": 10}).get_data())["id"]
+                for i in range(BOATS)]
+    load_ids = [json.loads(app.post("/loads", headers=headers, json={"volume": i + 1, "item": "item", "creation_date": "1/1/2023"}).get_data())["id"]
+                for i in range(LOADS)]
+
+    statuses = {}
+    latencies = []
+    lock = threading.Lock()
+
+    def worker(seed):
+        rng = random.Random(seed)
+        test_client = marina.app.test_client()
+        for _ in range(operations):
+            method = "PUT" if rng.random() < 0.6 else "DELETE"
+            url = "/boats/%d/loads/%d" % (rng.choice(boat_ids), rng.choice(load_ids))
+            start = time.perf_counter()
+            status = test_client.open(url, method=method, headers=headers).status_code
+            elapsed = time.perf_counter() - start
+            with lock:
+                statuses[(method, status)] = statuses.get((method, status), 0) + 1
+                latencies.append(elapsed)
+
+    start = time.perf_counter()
+    workers = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    elapsed = time.perf_counter() - start
+    errors = check(client, constants, boat_ids)
+
+    # every thread tries to put one free load on a different boat
+    free = [l.key.id for l in client.query(kind=constants.loads).fetch() if not l["carrier"]]
+    race = {}
+    if free:
+        barrier = threading.Barrier(threads)
+
+        def racer(i):
+            test_client = marina.app.test_client()
+            barrier.wait()
+            status = test_client.put("/boats/%d/loads/%d" % (boat_ids[i % BOATS], free[0]), headers=headers).status_code
+            with lock:
+                race[status] = race.get(status, 0) + 1
+        racers = [threading.Thread(target=racer, args=(i,)) for i in range(threads)]
+        for t in racers:
+            t.start()
+        for t in racers:
+            t.join()
+        if race.get(204) != 1:
+            errors.append("%d requests assigned the same load" % race.get(204, 0))
+        errors += check(client, constants, boat_ids)
+
+    total = threads * operations
+    print("backend:     %s" % harness.backend_name(fake))
+    print("requests:    %d in %.2fs, %.0f/s" % (total, elapsed, total / elapsed))
+    print("latency:     p50 %.1fms  p99 %.1fms" % (percentile(latencies, 0.5) * 1000, percentile(latencies, 0.99) * 1000))
+    print("statuses:    %s" % ", ".join("%s %d: %d" % (m, s, n) for (m, s), n in sorted(statuses.items())))
+    print("race:        %s" % race)
+    if fake:
+        print("aborted:     %d commits" % fake.aborted)
+    print("lost updates: %s" % ("none" if not errors else "\n  " + "\n  ".join(errors)))
+    sys.exit(1 if errors else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,272 @@
+# Endpoint benchmark: seeds boats and loads, replays a mixed workload of list
+# paging, single reads, assign/unassign and bulk deletes from several threads,
+# and reports per operation throughput, latency percentiles and Datastore RPCs
+# per request (from the Server-Timing header). The report is JSON so CI can
+# keep the one from the base commit and compare:
+#   python benchmarks/endpoints.py --output new.json --compare base.json
+# Runs against the Datastore emulator when DATASTORE_EMULATOR_HOST is set,
+# otherwise against the in-memory fake.
+import argparse
+import json
+import platform
+import random
+import re
+import subprocess
+import sys
+import threading
+import time
+from urllib.parse import urlparse
+
+import harness
+
+OWNER = "bench|owner"
+# operation name: (weight in the mixed workload, route it exercises)
+OPERATIONS = {
+    "list_boats": (3, "GET /boats"),
+    "list_loads": (3, "GET /loads"),
+    "filter_loads": (2, "GET /loads?volume_min&sort"),
+    "get_boat": (4, "GET /boats/<id>"),
+    "boat_loads": (3, "GET /boats/<id>/loads"),
+    "get_load": (4, "GET /loads/<id>"),
+    "assign": (2, "PUT /boats/<bid>/loads/<lid>"),
+    "unassign": (2, "DELETE /boats/<bid>/loads/<lid>"),
+    "bulk_delete": (1, "DELETE /loads:batch"),
+}
+BULK_SIZE = 20
+RPCS = re.compile(r'datastore;[^,]*desc="(\d+) rpcs"')
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+# The path and query of a next link, or None at the last page
+def path_of(url):
+    if not url:
+        return None
+    parsed = urlparse(url)
+    return parsed.path + "?" + parsed.query
+
+
+# The seeded state the operations draw from. Loads move between the free and
+# carried pools as they are assigned and unassigned, and leave both when bulk
+# deleted; boats only need to be read.
+class State:
+    def __init__(self, boat_ids, carried, free, loads_per_boat):
+        self.boat_ids = boat_ids
+        self.carried = {}
+        for i, load_id in enumerate(carried):
+            self.carried[load_id] = boat_ids[i // loads_per_boat]
+        self.free = list(free)
+        self.lock = threading.Lock()
+
+    def take_free(self, rng):
+        with self.lock:
+            if not self.free:
+                return None
+            return self.free.pop(rng.randrange(len(self.free)))
+
+    def take_carried(self, rng):
+        with self.lock:
+            if not self.carried:
+                return None, None
+            load_id = rng.choice(list(self.carried))
+            return load_id, self.carried.pop(load_id)
+
+    def put_back(self, load_id, boat_id=None):
+        with self.lock:
+            if boat_id is None:
+                self.free.append(load_id)
+            else:
+                self.carried[load_id] = boat_id
+
+    def take_free_many(self, rng, n):
+        with self.lock:
+            rng.shuffle(self.free)
+            taken, self.free = self.free[:n], self.free[n:]
+            return taken
+
+
+# Run one operation, returning the responses it made
+def run(op, app, headers, state, rng, cursors):
+    json_only = {"Accept": "application/json"}
+    if op == "list_boats":
+        url = cursors.get(op) or "/boats?limit=20"
+        response = app.get(url, headers=headers)
+        cursors[op] = path_of(json.loads(response.get_data()).get("next"))
+        return [response]
+    if op == "list_loads":
+        url = cursors.get(op) or "/loads?limit=50"
+        response = app.get(url, headers=json_only)
+        cursors[op] = path_of(json.loads(response.get_data()).get("next"))
+        return [response]
+    if op == "filter_loads":
+        low = rng.randrange(0, 90)
+        return [app.get("/loads?volume_min=%d&volume_max=%d&sort=volume&limit=20" % (low, low + 10), headers=json_only)]
+    if op == "get_boat":
+        return [app.get("/boats/%d" % rng.choice(state.boat_ids), headers=headers)]
+    if op == "boat_loads":
+        return [app.get("/boats/%d/loads?limit=20" % rng.choice(state.boat_ids), headers=headers)]
+    if op == "get_load":
+        with state.lock:
+            pool = state.free or list(state.carried)
+            load_id = rng.choice(pool) if pool else 0
+        return [app.get("/loads/%d" % load_id, headers=json_only)]
+    if op == "assign":
+        load_id = state.take_free(rng)
+        if load_id is None:
+            return []
+        boat_id = rng.choice(state.boat_ids)
+        response = app.put("/boats/%d/loads/%d" % (boat_id, load_id), headers=headers)
+        state.put_back(load_id, boat_id if response.status_code == 204 else None)
+        return [response]
+    if op == "unassign":
+        load_id, boat_id = state.take_carried(rng)
+        if load_id is None:
+            return []
+        response = app.delete("/boats/%d/loads/%d" % (boat_id, load_id), headers=headers)
+        state.put_back(load_id, None if response.status_code == 204 else boat_id)
+        return [response]
+    if op == "bulk_delete":
+        ids = state.take_free_many(rng, BULK_SIZE)
+        if not ids:
+            return []
+        return [app.delete("/loads:batch?ids=" + ",".join(str(i) for i in ids), headers=json_only)]
+    raise ValueError(op)
+
+
+def summarize(samples, elapsed):
+    latencies = [s[0] for s in samples]
+    rpcs = [s[1] for s in samples if s[1] is not None]
+    errors = sum(1 for s in samples if s[2] >= 500)
+    return {
+        "requests": len(samples),
+        "errors": errors,
+        "throughput_rps": len(samples) / elapsed if elapsed else 0.0,
+        "mean_ms": sum(latencies) / len(latencies) * 1000,
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p90_ms": percentile(latencies, 0.90) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "rpcs_per_request": sum(rpcs) / len(rpcs) if rpcs else 0.0,
+    }
+
+
+def commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=harness.ROOT,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# Print the change of each operation's latency and RPCs against a baseline
+# report. Returns the operations whose p50 or RPCs per request grew by more
+# than threshold.
+def compare(report, baseline, threshold):
+    regressions = []
+    print("\n%-14s %12s %12s %8s %10s %10s" % ("vs " + str(baseline["meta"].get("commit")), "base p50", "p50", "change", "base rpcs", "rpcs"))
+    for op, stats in sorted(report["operations"].items()):
+        base = baseline["operations"].get(op)
+        if not base:
+            continue
+        change = stats["p50_ms"] / base["p50_ms"] - 1 if base["p50_ms"] else 0.0
+        flag = ""
+        if change > threshold or stats["rpcs_per_request"] > base["rpcs_per_request"] * (1 + threshold):
+            regressions.append(op)
+            flag = "  <- regression"
+        print("%-14s %12.2f %12.2f %+7.0f%% %10.1f %10.1f%s" % (op, base["p50_ms"], stats["p50_ms"], change * 100,
+                                                            base["rpcs_per_request"], stats["rpcs_per_request"], flag))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark Marina's endpoints under a mixed workload")
+    parser.add_argument("--boats", type=int, default=50)
+    parser.add_argument("--loads-per-boat", type=int, default=20)
+    parser.add_argument("--free-loads", type=int, default=2000)
+    parser.add_argument("--requests", type=int, default=2000, help="operations in total, over all threads")
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--workload", default="mixed", choices=["mixed"] + sorted(OPERATIONS))
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="write the JSON report to this file")
+    parser.add_argument("--compare", help="baseline JSON report to compare against")
+    parser.add_argument("--threshold", type=float, default=0.25,
+                        help="p50 growth over the baseline that counts as a regression (default 0.25)")
+    args = parser.parse_args()
+
+    issuer = harness.Issuer()
+    harness.use_issuer(issuer)
+    marina, client, fake = harness.start_app()
+    boat_ids, carried, free = harness.seed(client, OWNER, args.boats, args.loads_per_boat, args.free_loads)
+    state = State(boat_ids, carried, free, args.loads_per_boat)
+    headers = issuer.headers(OWNER)
+    if args.workload == "mixed":
+        names = sorted(OPERATIONS)
+        weights = [OPERATIONS[name][0] for name in names]
+    else:
+        names, weights = [args.workload], [1]
+
+    samples = {}
+    lock = threading.Lock()
+
+    def worker(n, count):
+        rng = random.Random(args.seed * 1000 + n)
+        app = marina.app.test_client()
+        cursors = {}
+        for _ in range(count):
+            op = rng.choices(names, weights)[0]
+            start = time.perf_counter()
+            responses = run(op, app, headers, state, rng, cursors)
+            elapsed = time.perf_counter() - start
+            if not responses:
+                continue
+            matches = [RPCS.search(r.headers.get("Server-Timing", "")) for r in responses]
+            rpcs = sum(int(m.group(1)) for m in matches if m) if any(matches) else None
+            status = max(r.status_code for r in responses)
+            with lock:
+                samples.setdefault(op, []).append((elapsed, rpcs, status))
+
+    # one warm-up request per operation so JWKS fetches and first-use setup
+    # are not measured
+    warm = marina.app.test_client()
+    for op in names:
+        run(op, warm, headers, state, random.Random(0), {})
+
+    per_thread = [args.requests // args.threads + (1 if i < args.requests % args.threads else 0) for i in range(args.threads)]
+    threads = [threading.Thread(target=worker, args=(i, count)) for i, count in enumerate(per_thread)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+
+    everything = [s for op_samples in samples.values() for s in op_samples]
+    report = {
+        "meta": {"commit": commit(), "backend": harness.backend_name(fake), "python": platform.python_version(),
+                 "boats": args.boats, "loads_per_boat": args.loads_per_boat, "free_loads": args.free_loads,
+                 "requests": args.requests, "threads": args.threads, "workload": args.workload,
+                 "seed": args.seed, "seconds": elapsed},
+        "operations": {op: dict(summarize(op_samples, elapsed), route=OPERATIONS[op][1])
+                       for op, op_samples in sorted(samples.items())},
+        "total": summarize(everything, elapsed),
+    }
+
+    print("%d requests in %.2fs on the %s, %d threads" % (len(everything), elapsed, report["meta"]["backend"], args.threads))
+    print("%-14s %8s %8s %9s %9s %9s %9s %7s" % ("operation", "requests", "errors", "req/s", "p50 ms", "p90 ms", "p99 ms", "rpcs"))
+    for op, stats in list(report["operations"].items()) + [("total", report["total"])]:
+        print("%-14s %8d %8d %9.0f %9.2f %9.2f %9.2f %7.1f" % (op, stats["requests"], stats["errors"], stats["throughput_rps"],
+                                                             stats["p50_ms"], stats["p90_ms"], stats["p99_ms"], stats["rpcs_per_request"]))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    regressions = []
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(report, json.load(f), args.threshold)
+    sys.exit(1 if regressions or report["total"]["errors"] else 0)
+
+
+if __name__ == "__main__":
+    main()
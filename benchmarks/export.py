@@ -0,0 +1,75 @@
+# Show that peak RSS while streaming GET /loads/export stays flat as the
+# number of loads grows. Each size is seeded and exported in a fresh process.
+# Needs the Datastore emulator (see benchmarks/pagination.py):
+#   python benchmarks/export.py [size ...]      (default: 1000 10000 100000 1000000)
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+
+
+def seed(total):
+    from google.cloud import datastore
+    import constants
+
+    client = datastore.Client()
+    existing = client.query(kind=constants.loads)
+    existing.keys_only()
+    keys = [e.key for e in existing.fetch()]
+    for i in range(0, len(keys), 500):
+        client.delete_multi(keys[i:i + 500])
+    batch = []
+    for i in range(total):
+        entity = datastore.Entity(key=client.key(constants.loads))
+        entity.update({"volume": i, "item": "item " + str(i),
+                       "creation_date": "1/1/2023", "carrier": None})
+        batch.append(entity)
+        if len(batch) == 500:
+            client.put_multi(batch)
+            batch = []
+    if batch:
+        client.put_multi(batch)
+
+
+def export():
+    # rate limiting is off, like in the other benchmarks
+    os.environ.setdefault("ratelimit_rate", "0")
+    import main
+
+    start = time.perf_counter()
+    response = main.app.test_client().get("/loads/export", headers={"Accept": "application/x-ndjson"},
+                                          buffered=False)
+    lines = 0
+    size = 0
+    for chunk in response.response:
+        lines += chunk.count(b"\n")
+        size += len(chunk)
+    elapsed = time.perf_counter() - start
+    peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(json.dumps({"lines": lines, "bytes": size, "seconds": elapsed, "peak_rss_kb": peak_kb}))
+
+
+def main():
+    if "DATASTORE_EMULATOR_HOST" not in os.environ:
+        sys.exit("DATASTORE_EMULATOR_HOST is not set, start the emulator first")
+    if sys.argv[1:2] == ["--child"]:
+        seed(int(sys.argv[2]))
+        export()
+        return
+    sizes = [int(s) for s in sys.argv[1:]] or [1000, 10000, 100000, 1000000]
+    print("%10s %12s %10s %14s" % ("loads", "lines", "seconds", "peak RSS MB"))
+    for size in sizes:
+        output = subprocess.run([sys.executable, os.path.abspath(__file__), "--child", str(size)],
+                                cwd=ROOT, check=True, capture_output=True, text=True).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        print("%10d %12d %10.2f %14.1f" % (size, result["lines"], result["seconds"],
+                                           result["peak_rss_kb"] / 1024))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,281 @@
+# In-memory stand-in for google.cloud.datastore.Client, for benchmarks that
+# should run without the Datastore emulator. It covers the calls Marina makes:
+# keys, lookups, writes, id allocation, filtered/ordered/projected queries with
+# cursors, and transactions. Transactions are optimistic like Datastore's: the
+# entities a transaction reads are checked at commit, and if another commit
+# changed one of them in the meantime the commit fails with Aborted.
+import base64
+import copy
+import itertools
+import threading
+
+from google.api_core import exceptions
+from google.cloud import datastore
+
+PROJECT = "marina-fake"
+
+
+def _lookup(entity, name):
+    value = entity
+    for part in name.split("."):
+        if not isinstance(value, dict) or part not in value:
+            return None
+        value = value[part]
+    return value
+
+
+def _compare(value, op, target):
+    if op in ("=", "=="):
+        if isinstance(value, list):
+            return target in value
+        return value == target
+    if op == "IN":
+        if isinstance(value, list):
+            return any(v in target for v in value)
+        return value in target
+    if value is None or target is None:
+        return False
+    try:
+        if op == "<":
+            return value < target
+        if op == "<=":
+            return value <= target
+        if op == ">":
+            return value > target
+        if op == ">=":
+            return value >= target
+        if op == "!=":
+            return value != target
+    except TypeError:
+        return False
+    raise ValueError("unsupported operator " + op)
+
+
+# (kind, id or name) of a key, read from flat_path because Key.kind and
+# Key.id copy the whole path on every access
+def _key_id(key):
+    path = key.flat_path
+    if len(path) % 2:
+        return (path[-1], 0)
+    return (path[-2], path[-1])
+
+
+class FakeIterator:
+    def __init__(self, query, limit, offset, start_cursor):
+        self._query = query
+        self._limit = limit
+        self._offset = offset or 0
+        self._start_cursor = start_cursor
+        self.next_page_token = None
+        self.num_results = 0
+
+    # like the real iterator, a bad cursor only fails once results are read
+    def _position(self):
+        cursor = self._start_cursor
+        if not cursor:
+            return 0
+        if isinstance(cursor, str):
+            cursor = cursor.encode("ascii")
+        return int(base64.urlsafe_b64decode(cursor).decode("ascii"))
+
+    def _results(self):
+        start = self._position() + self._offset
+        matches = self._query._matches()
+        end = len(matches) if self._limit is None else start + self._limit
+        page = matches[start:end]
+        if end < len(matches) or (self._limit is not None and len(page) == self._limit):
+            self.next_page_token = base64.urlsafe_b64encode(str(start + len(page)).encode("ascii"))
+        else:
+            self.next_page_token = None
+        self.num_results = len(page)
+        # only the page is copied out of the store
+        return [self._query._result(e) for e in page]
+
+    @property
+    def pages(self):
+        yield iter(self._results())
+
+    def __iter__(self):
+        return iter(self._results())
+
+
+class FakeQuery:
+    def __init__(self, client, kind):
+        self._client = client
+        self.kind = kind
+        self.filters = []
+        self.projection = []
+        self.order = []
+        self.distinct_on = []
+        self._keys_only = False
+
+    def add_filter(self, property_name, operator, value):
+        self.filters.append((property_name, operator, value))
+        return self
+
+    def keys_only(self):
+        self.projection = ["__key__"]
+        self._keys_only = True
+
+    def _matches(self):
+        self._client._rpc("RunQuery")
+        entities = self._client._entities_of(self.kind)
+        for name, op, target in self.filters:
+            entities = [e for e in entities if _compare(_lookup(e, name), op, target)]
+        entities.sort(key=lambda e: _key_id(e.key))
+        for prop in reversed(self.order):
+            desc = prop.startswith("-")
+            name = prop.lstrip("-")
+            entities = [e for e in entities if _lookup(e, name) is not None]
+            entities.sort(key=lambda e: _lookup(e, name), reverse=desc)
+        return entities
+
+    def _result(self, e):
+        if self._keys_only:
+            return datastore.Entity(key=e.key)
+        if self.projection:
+            projected = datastore.Entity(key=e.key)
+            for name in self.projection:
+                projected[name] = copy.deepcopy(e.get(name))
+            return projected
+        return self._client._copy(e)
+
+    def fetch(self, limit=None, offset=0, start_cursor=None, end_cursor=None, client=None, **kwargs):
+        return FakeIterator(self, limit, offset, start_cursor)
+
+
+class FakeTransaction:
+    def __init__(self, client):
+        self._client = client
+        self._reads = {}
+        self._writes = {}
+
+    def __enter__(self):
+        self._client._rpc("BeginTransaction")
+        self._client._local.transaction = self
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._client._local.transaction = None
+        if exc_type is not None:
+            self._client._rpc("Rollback")
+            return False
+        self._client._commit(self)
+        return False
+
+
+class Client:
+    def __init__(self, project=PROJECT):
+        self.project = project
+        self.namespace = None
+        self._store = {}
+        self._kinds = {}
+        self._versions = {}
+        self._ids = itertools.count(1000)
+        self._lock = threading.RLock()
+        self._local = threading.local()
+        self.rpc_counts = {}
+        self.aborted = 0
+
+    def _rpc(self, name):
+        with self._lock:
+            self.rpc_counts[name] = self.rpc_counts.get(name, 0) + 1
+
+    def _entities_of(self, kind):
+        with self._lock:
+            return list(self._kinds.get(kind, {}).values())
+
+    def _commit(self, transaction):
+        self._rpc("Commit")
+        with self._lock:
+            for key_id, version in transaction._reads.items():
+                if self._versions.get(key_id, 0) != version:
+                    self.aborted += 1
+                    raise exceptions.Aborted("too much contention on these datastore entities")
+            self._apply(transaction._writes)
+
+    def _apply(self, writes):
+        for key_id, entity in writes.items():
+            if entity is None:
+                self._store.pop(key_id, None)
+                self._kinds.get(key_id[0], {}).pop(key_id, None)
+            else:
+                self._store[key_id] = entity
+                self._kinds.setdefault(key_id[0], {})[key_id] = entity
+            self._versions[key_id] = self._versions.get(key_id, 0) + 1
+
+    @property
+    def current_transaction(self):
+        return getattr(self._local, "transaction", None)
+
+    @property
+    def current_batch(self):
+        return self.current_transaction
+
+    def _copy(self, entity):
+        result = datastore.Entity(key=entity.key, exclude_from_indexes=tuple(entity.exclude_from_indexes))
+        result.update(copy.deepcopy(dict(entity)))
+        return result
+
+    def _write(self, writes):
+        transaction = self.current_transaction
+        if transaction is not None:
+            transaction._writes.update(writes)
+            return
+        self._rpc("Commit")
+        with self._lock:
+            self._apply(writes)
+
+    def key(self, *path, **kwargs):
+        kwargs.setdefault("project", self.project)
+        return datastore.Key(*path, **kwargs)
+
+    def transaction(self, **kwargs):
+        return FakeTransaction(self)
+
+    def batch(self):
+        return FakeTransaction(self)
+
+    def query(self, kind=None, **kwargs):
+        return FakeQuery(self, kind)
+
+    def allocate_ids(self, incomplete_key, num_ids, **kwargs):
+        self._rpc("AllocateIds")
+        return [incomplete_key.completed_key(next(self._ids)) for _ in range(num_ids)]
+
+    def get(self, key, **kwargs):
+        found = self.get_multi([key])
+        return found[0] if found else None
+
+    def get_multi(self, keys, missing=None, **kwargs):
+        self._rpc("Lookup")
+        transaction = self.current_transaction
+        with self._lock:
+            found = []
+            for key in keys:
+                key_id = _key_id(key)
+                if transaction is not None:
+                    transaction._reads.setdefault(key_id, self._versions.get(key_id, 0))
+                entity = self._store.get(key_id)
+                if entity is not None:
+                    found.append(self._copy(entity))
+                elif missing is not None:
+                    missing.append(datastore.Entity(key=key))
+            return found
+
+    def put(self, entity, **kwargs):
+        self.put_multi([entity])
+
+    def put_multi(self, entities, **kwargs):
+        writes = {}
+        for entity in entities:
+            if entity.key.is_partial:
+                entity.key = entity.key.completed_key(next(self._ids))
+            writes[_key_id(entity.key)] = self._copy(entity)
+        self._write(writes)
+
+    def delete(self, key, **kwargs):
+        self.delete_multi([key])
+
+    def delete_multi(self, keys, **kwargs):
+        self._write({_key_id(key): None for key in keys})
@@ -0,0 +1,126 @@
+# Shared setup for the benchmarks: a local JWKS server and token issuer in
+# place of Auth0, the app wired to the Datastore emulator (when
+# DATASTORE_EMULATOR_HOST is set) or to the in-memory fake, and seeding of
+# boats and loads straight into the datastore.
+import base64
+import json
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import rsa
+from jose import jwt
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+
+KID = "bench-key"
+AUDIENCE = "bench-audience"
+
+
+def b64(n):
+    data = n.to_bytes((n.bit_length() + 7) // 8, "big")
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+
+
+def serve_jwks(pub):
+    body = json.dumps({"keys": [{"kty": "RSA", "kid": KID, "use": "sig",
+                                 "n": b64(pub.n), "e": b64(pub.e)}]}).encode("utf-8")
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return "http://127.0.0.1:%d/.well-known/jwks.json" % server.server_port
+
+
+# Signs RS256 tokens that verify_jwt accepts once the app is pointed at
+# this issuer's JWKS with use_issuer
+class Issuer:
+    def __init__(self, bits=2048):
+        self.public, self._private = rsa.newkeys(bits)
+        self.jwks_url = serve_jwks(self.public)
+
+    def token(self, sub, lifetime=3600):
+        import auth
+        claims = {"sub": sub, "aud": AUDIENCE, "iss": auth.ISSUER,
+                  "iat": int(time.time()), "exp": int(time.time()) + lifetime}
+        return jwt.encode(claims, self._private.save_pkcs1().decode("ascii"),
+                          algorithm="RS256", headers={"kid": KID})
+
+    def headers(self, sub):
+        return {"Authorization": "Bearer " + self.token(sub), "Accept": "application/json"}
+
+
+# Point auth at issuer; must run before auth is imported
+def use_issuer(issuer):
+    os.environ["jwks_url"] = issuer.jwks_url
+    os.environ["client_id"] = AUDIENCE
+
+
+# Import the app and give it a datastore client: the emulator's when
+# DATASTORE_EMULATOR_HOST is set, otherwise a fresh in-memory fake. Returns
+# (main module, client, fake or None). Rate limiting is off unless
+# ratelimit_rate is set, so the benchmarks measure the endpoints themselves.
+def start_app():
+    os.environ.setdefault("ratelimit_rate", "0")
+    import db
+    import main
+
+    fake = None
+    if not os.environ.get("DATASTORE_EMULATOR_HOST"):
+        import fake_datastore
+        fake = fake_datastore.Client()
+        db.set_client(fake)
+    return main, db.get_client(), fake
+
+
+def backend_name(fake):
+    return "fake" if fake is not None else "emulator"
+
+
+# Write boats owned by owner, each carrying loads_per_boat loads, and
+# free_loads loads without a carrier. Returns (boat ids, carried load ids,
+# free load ids).
+def seed(client, owner, boats, loads_per_boat, free_loads):
+    from google.cloud import datastore
+    import batch
+    import constants
+
+    boat_keys = client.allocate_ids(client.key(constants.boats), boats) if boats else []
+    load_total = boats * loads_per_boat + free_loads
+    load_keys = client.allocate_ids(client.key(constants.loads), load_total) if load_total else []
+    entities = []
+    carried = []
+    for b, boat_key in enumerate(boat_keys):
+        boat = datastore.Entity(key=boat_key)
+        volume = 0
+        for i in range(loads_per_boat):
+            load_key = load_keys[b * loads_per_boat + i]
+            load = datastore.Entity(key=load_key)
+            load.update({"volume": i + 1, "item": "item %d" % i, "creation_date": "1/1/2023",
+                         "carrier": {"id": boat_key.id, "name": "boat %d" % b}})
+            entities.append(load)
+            carried.append(load_key.id)
+            volume += i + 1
+        boat.update({"name": "boat %d" % b, "type": "barge", "length": 100, "owner": owner,
+                     "load_count": loads_per_boat, "total_volume": volume})
+        entities.append(boat)
+    free = []
+    for load_key in load_keys[boats * loads_per_boat:]:
+        load = datastore.Entity(key=load_key)
+        load.update({"volume": load_key.id % 100, "item": "free", "creation_date": "1/1/2023", "carrier": None})
+        entities.append(load)
+        free.append(load_key.id)
+    batch.put_multi(client, entities)
+    return [key.id for key in boat_keys], carried, free
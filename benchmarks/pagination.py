@@ -0,0 +1,82 @@
+# Compare the latency of fetching page N of GET /loads by offset and by cursor.
+# Needs the Datastore emulator, e.g.
+#   gcloud beta emulators datastore start --no-store-on-disk &
+#   $(gcloud beta emulators datastore env-init)
+#   python benchmarks/pagination.py [number_of_loads]
+import os
+import sys
+import time
+from urllib.parse import urlparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from google.cloud import datastore
+
+import constants
+
+LIMIT = 5
+REPEAT = 5
+
+
+def seed(client, total):
+    existing = client.query(kind=constants.loads)
+    existing.keys_only()
+    client.delete_multi([e.key for e in existing.fetch()])
+    batch = []
+    for i in range(total):
+        entity = datastore.Entity(key=client.key(constants.loads))
+        entity.update({"volume": i, "item": "item " + str(i),
+                       "creation_date": "1/1/2023", "carrier": None})
+        batch.append(entity)
+        if len(batch) == 500:
+            client.put_multi(batch)
+            batch = []
+    if batch:
+        client.put_multi(batch)
+
+
+def timed_get(app_client, url):
+    best = None
+    for _ in range(REPEAT):
+        start = time.perf_counter()
+        response = app_client.get(url, headers={"Accept": "application/json"})
+        elapsed = time.perf_counter() - start
+        assert response.status_code == 200, response.data
+        best = elapsed if best is None else min(best, elapsed)
+    return best * 1000
+
+
+def main():
+    if "DATASTORE_EMULATOR_HOST" not in os.environ:
+        sys.exit("DATASTORE_EMULATOR_HOST is not set, start the emulator first")
+    total = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    # walking every page would soon run out of rate limit tokens
+    os.environ.setdefault("ratelimit_rate", "0")
+    import main as marina
+
+    client = datastore.Client()
+    seed(client, total)
+    app_client = marina.app.test_client()
+
+    # walk the cursor links once, remembering the link to each page
+    cursors = {0: "/loads?limit=%d" % LIMIT}
+    url, page = cursors[0], 0
+    while url and (page + 1) * LIMIT < total:
+        body = app_client.get(url, headers={"Accept": "application/json"}).get_json(force=True)
+        url = body.get("next")
+        page += 1
+        if url:
+            parsed = urlparse(url)
+            cursors[page] = parsed.path + "?" + parsed.query
+
+    print("%8s %12s %12s" % ("page", "offset ms", "cursor ms"))
+    page = 1
+    while page in cursors:
+        offset_ms = timed_get(app_client, "/loads?limit=%d&offset=%d" % (LIMIT, page * LIMIT))
+        cursor_ms = timed_get(app_client, cursors[page])
+        print("%8d %12.2f %12.2f" % (page, offset_ms, cursor_ms))
+        page *= 10
+
+
+if __name__ == "__main__":
+    main()
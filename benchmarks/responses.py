@@ -0,0 +1,94 @@
+# Bytes on the wire and CPU spent serializing list pages of 5, 100 and 1000
+# loads, for every JSON encoder responses.py has and every content coding it
+# can compress with. Each page is rendered the way GET /loads renders it:
+# views with links are built from the entities, then encoded, then
+# compressed. Needs no Datastore:
+#   python benchmarks/responses.py [size ...] [--repeat N] [--output report.json]
+import argparse
+import json
+import os
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+
+URL_ROOT = "http://localhost:8080/"
+
+
+def page(size):
+    from google.cloud import datastore
+    import constants
+
+    entities = []
+    for i in range(size):
+        load = datastore.Entity(key=datastore.Key(constants.loads, 1000 + i, project="bench"))
+        carrier = {"id": 1 + i % 7, "name": "boat %d" % (i % 7)} if i % 3 else None
+        load.update({"volume": i % 100, "item": "item %d" % i, "creation_date": "1/1/2023", "carrier": carrier})
+        entities.append(load)
+    return entities
+
+
+# CPU seconds per call of fn, the best of repeat runs of enough calls to take
+# a measurable time
+def cpu(fn, repeat):
+    calls = 1
+    while True:
+        start = time.process_time()
+        for _ in range(calls):
+            fn()
+        if time.process_time() - start >= 0.02:
+            break
+        calls *= 4
+    best = None
+    for _ in range(repeat):
+        start = time.process_time()
+        for _ in range(calls):
+            fn()
+        elapsed = (time.process_time() - start) / calls
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def measure(size, repeat):
+    import responses
+
+    entities = page(size)
+    results = []
+    for name, encode in sorted(responses.ENCODERS.items()):
+        def render():
+            return encode({"loads": [responses.load_view(e, URL_ROOT) for e in entities], "total_items": size})
+        body = render()
+        result = {"size": size, "encoder": name, "serialize_ms": cpu(render, repeat) * 1000,
+                  "bytes": {"identity": len(body)}, "compress_ms": {}}
+        for coding in sorted(responses.CODINGS):
+            result["bytes"][coding] = len(responses.compress(body, coding))
+            result["compress_ms"][coding] = cpu(lambda: responses.compress(body, coding), repeat) * 1000
+        results.append(result)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure response size and serialization cost per page size")
+    parser.add_argument("sizes", nargs="*", type=int, default=[5, 100, 1000])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    args = parser.parse_args()
+
+    import constants
+
+    results = [r for size in args.sizes for r in measure(size, args.repeat)]
+    print("pages below %d bytes are sent uncompressed" % constants.compress_min_size)
+    print("%6s %8s %12s %10s %10s %10s %12s %12s" % ("loads", "encoder", "serialize ms", "identity", "gzip", "deflate",
+                                                      "gzip ms", "deflate ms"))
+    for r in results:
+        print("%6d %8s %12.3f %10d %10d %10d %12.3f %12.3f" % (r["size"], r["encoder"], r["serialize_ms"],
+                                                              r["bytes"]["identity"], r["bytes"]["gzip"], r["bytes"]["deflate"],
+                                                              r["compress_ms"]["gzip"], r["compress_ms"]["deflate"]))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,42 @@
+# Measure cold-start cost: importing the app and serving its first request,
+# each run in a fresh interpreter like an App Engine instance start.
+#   python benchmarks/startup.py [runs] [path]
+# Paths that touch Datastore need credentials or the emulator
+# (DATASTORE_EMULATOR_HOST); the default path, /, needs neither.
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+CHILD = """
+import json, sys, time
+start = time.perf_counter()
+import main
+imported = time.perf_counter()
+response = main.app.test_client().get(sys.argv[1], headers={"Accept": "application/json"})
+done = time.perf_counter()
+print(json.dumps({"import": imported - start, "first_response": done - imported,
+                  "total": done - start, "status": response.status_code}))
+"""
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    path = sys.argv[2] if len(sys.argv) > 2 else "/"
+    results = []
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, "-c", CHILD, path], cwd=ROOT,
+                                check=True, capture_output=True, text=True).stdout
+        results.append(json.loads(output.strip().splitlines()[-1]))
+    print("%d runs of GET %s (status %s)" % (runs, path, results[-1]["status"]))
+    for name in ("import", "first_response", "total"):
+        values = sorted(r[name] * 1000 for r in results)
+        print("%-15s median %8.1f ms   min %8.1f ms   max %8.1f ms" % (
+            name, statistics.median(values), values[0], values[-1]))
+
+
+if __name__ == "__main__":
+    main()
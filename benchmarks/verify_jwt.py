@@ -0,0 +1,56 @@
+# Compare verify_jwt throughput with the verified-token cache on and off.
+# Serves a throwaway JWKS from a local HTTP server and signs tokens locally,
+# so no Auth0 tenant is needed:
+#   python benchmarks/verify_jwt.py [iterations]
+import os
+import sys
+import time
+
+import rsa
+from jose import jwt
+
+from harness import AUDIENCE, KID, serve_jwks
+
+
+class FakeRequest:
+    def __init__(self, token):
+        self.headers = {"Authorization": "Bearer " + token}
+
+
+def run(auth, request, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        auth.verify_jwt(request)
+    return iterations / (time.perf_counter() - start)
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    pub, priv = rsa.newkeys(2048)
+    os.environ["jwks_url"] = serve_jwks(pub)
+    os.environ["client_id"] = AUDIENCE
+    import auth
+
+    claims = {"sub": "bench|user", "aud": AUDIENCE, "iss": auth.ISSUER,
+              "iat": int(time.time()), "exp": int(time.time()) + 3600}
+    token = jwt.encode(claims, priv.save_pkcs1().decode("ascii"),
+                       algorithm="RS256", headers={"kid": KID})
+    request = FakeRequest(token)
+    # warm the key store so the JWKS fetch is not part of either run
+    auth.verify_jwt(request)
+
+    maxsize = auth.token_cache.maxsize
+    auth.token_cache.maxsize = 0
+    uncached = run(auth, request, iterations)
+    auth.token_cache.maxsize = maxsize
+    auth.token_cache.clear()
+    cached = run(auth, request, iterations)
+
+    print("cache off: %10.0f verifications/s" % uncached)
+    print("cache on:  %10.0f verifications/s" % cached)
+    print("speedup:   %10.1fx" % (cached / uncached))
+    print("stats:     %s" % auth.token_cache.stats())
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,97 @@
 from flask import Blueprint, request, Response
+from google.api_core import exceptions
 from google.cloud import datastore
+import functools
 import json
+import aggregates
+import batch
+import cache
 import constants
+import counter
+from db import client
+import etag
+import fieldsets
+import jobs
+import pagination
+import parallel
+import responses
+import transactions
 from auth import verify_jwt
 
-client = datastore.Client()
-
 bp = Blueprint('boat', __name__, url_prefix='/boats')
+# the batch routes are not under /boats/ so they get their own blueprint
+batch_bp = Blueprint('boat_batch', __name__)
+
+
+# Return an error message if content is not a complete boat, else None
+def validate_boat(content):
+    if not isinstance(content, dict) or len(content.items()) < 3:
+        return "The request object is missing at least one of the required attributes"
+    for attr in ("name", "type", "length"):
+        if attr not in content:
+            return "The request object is missing at least one of the required attributes"
+    return None
+
+
+# properties the server maintains, which clients can't write; owner only
+# changes through the boat counters, and loads is no longer stored
+READ_ONLY = ("owner", "loads", "load_count", "total_volume")
+
+
+# Return an error message if content tries to set a read-only property, else None
+def validate_patch(content):
+    if not isinstance(content, dict) or len(content.items()) < 1:
+        return "The request object is empty"
+    fixed = [attr for attr in READ_ONLY if attr in content]
+    if fixed:
+        return ", ".join(fixed) + " can't be changed"
+    return None
+
+
+# Views of boats whose "loads" are the full loads each carries, at most
+# constants.expand_loads_limit of them (the boat's load_count has the total).
+# The carrier.id queries of the boats run concurrently.
+def expand_loads(boats, url_root):
+    # boats holding at most expand_loads_limit loads are read together with
+    # an IN filter, bounded by their combined limit; a fuller boat gets a
+    # query of its own so it can't crowd out the others
+    def carried(ids):
+        query = client.query(kind=constants.loads)
+        if len(ids) == 1:
+            query.add_filter("carrier.id", "=", ids[0])
+        else:
+            query.add_filter("carrier.id", "IN", ids)
+        return list(query.fetch(limit=constants.expand_loads_limit * len(ids)))
+    if not boats:
+        return []
+    light = [boat.key.id for boat in boats if boat.get("load_count", 0) <= constants.expand_loads_limit]
+    groups = list(batch.chunks(light, constants.expand_boats_per_query))
+    groups += [[boat.key.id] for boat in boats if boat.get("load_count", 0) > constants.expand_loads_limit]
+    carried_by = {boat.key.id: [] for boat in boats}
+    for loads in parallel.run(*[functools.partial(carried, ids) for ids in groups]):
+        for load in loads:
+            held = carried_by.get(load["carrier"]["id"])
+            if held is not None and len(held) < constants.expand_loads_limit:
+                held.append(load)
+    views = []
+    for boat in boats:
+        view = responses.boat_view(boat, url_root)
+        view["loads"] = [responses.load_view(load, url_root) for load in carried_by[boat.key.id]]
+        views.append(view)
+    return views
+
+
+# Delete boats along with the owner's boat count in one transaction. Clearing
+# the carrier of their loads is left to jobs staged in the same transaction.
+def delete_boats(boats, owner):
+    for attempt in transactions.attempts(client):
+        with attempt:
+            current = batch.get_multi(client, [boat.key for boat in boats])
+            batch.delete_multi(client, [boat.key for boat in current])
+            counter.increment(client, counter.boats_counter(owner), -len(current))
+            staged = jobs.queue.stage(jobs.detach_jobs([boat.key.id for boat in current]))
+    cache.invalidate([boat.key for boat in boats])
+    jobs.queue.release(staged)
 
 
 @bp.route('', methods=['POST','GET', 'PUT', 'PATCH', 'DELETE'])
@@ -26,48 +111,64 @@ def boats_get_post():
         content = request.get_json()
         new_boat = datastore.entity.Entity(key=client.key(constants.boats))
         # if missing required attribute, 400 status code returned
-        if len(content.items()) < 3:
-            bad_request = {"Error" : "The request object is missing at least one of the required attributes"}
+        error = validate_boat(content)
+        if error:
+            bad_request = {"Error" : error}
             return Response(json.dumps(bad_request), status= 400)
         new_boat.update({'name': content['name'], 'type': content['type'],
-          'length': content['length'], "owner": owner, 'loads': []})
-        client.put(new_boat)
-        new_boat["id"] = new_boat.key.id
-        new_boat["self"] = request.url_root + "boats/" + str(new_boat["id"])
-        return Response(json.dumps(new_boat), status= 201)
+          'length': content['length'], "owner": owner,
+          'load_count': 0, 'total_volume': 0})
+        # the owner's boat count is updated in the same commit as the boat
+        for attempt in transactions.attempts(client):
+            with attempt:
+                client.put(new_boat)
+                counter.increment(client, counter.boats_counter(owner), 1)
+        cache.refresh(new_boat)
+        return Response(responses.dumps(responses.boat_view(new_boat, request.url_root)), status= 201)
     elif request.method == 'GET':
         # if client does not accept response as JSON, 406 status returned
         if 'application/json' not in request.accept_mimetypes:
             not_json = {"Error" : "Accept header must accept response content type application/json"}
             return Response(json.dumps(not_json), status= 406)
+        expand = request.args.get('expand')
+        if expand not in (None, 'loads'):
+            bad_request = {"Error" : "Only loads can be expanded"}
+            return Response(json.dumps(bad_request), status= 400)
+        try:
+            fields = fieldsets.parse(request, constants.boats)
+        except fieldsets.FieldsError as e:
+            bad_request = {"Error" : e.message}
+            return Response(json.dumps(bad_request), status= 400)
         # verify user and show user's boats 5 per page
         payload = verify_jwt(request)
         owner = payload["sub"]
         query_count = client.query(kind=constants.boats)
         query_count.add_filter("owner", "=", owner)
-        total_items = len(list(query_count.fetch()))
         query = client.query(kind=constants.boats)
         query.add_filter("owner", "=", owner)
-        q_limit = int(request.args.get('limit', '5'))
-        q_offset = int(request.args.get('offset', '0'))
-        l_iterator = query.fetch(limit= q_limit, offset=q_offset)
-        pages = l_iterator.pages
-        results = list(next(pages))
-        if l_iterator.next_page_token:
-            next_offset = q_offset + q_limit
-            next_url = request.base_url + "?limit=" + str(q_limit) + "&offset=" + str(next_offset)
+        # read only the requested properties when an index allows it
+        projected = fieldsets.projection("boats", fields)
+        if projected:
+            query.projection = projected
+        # the count and the page are read at the same time
+        try:
+            total_items, (results, next_url) = parallel.run(
+                lambda: counter.count(client, counter.boats_counter(owner), query_count),
+                lambda: pagination.fetch_page(query, request))
+        except pagination.PaginationError as e:
+            bad_request = {"Error" : e.message}
+            return Response(json.dumps(bad_request), status= 400)
+        # boats only list their loads when they are expanded
+        if expand:
+            results = expand_loads(results, request.url_root)
         else:
-            next_url = None
-        for e in results:
-            e["id"] = e.key.id
-            e["self"] = request.url_root + "boats/" + str(e["id"])
-            for load in e["loads"]:
-                if load:
-                    load["self"] = request.url_root + "loads/" + str(load["id"])
+            results = [responses.boat_view(e, request.url_root) for e in results]
+        if fields:
+            results = [fieldsets.select(e, fields) for e in results]
         output = {"total_items": total_items, "boats": results}
         if next_url:
             output["next"] = next_url
-        return Response(json.dumps(output), status= 200)
+        return etag.conditional(request, Response(responses.dumps(output), status= 200))
     elif request.method == 'PUT':
         unsupported_method = {"Error" : "Method not supported"}
         return Response(json.dumps(unsupported_method), status= 405)
@@ -96,24 +197,39 @@ def boats_put_delete(id):
         owner = payload["sub"]
         content = request.get_json()
         boat_key = client.key(constants.boats, int(id))
-        boat = client.get(key=boat_key)
-        # if invalid id, 404 status code
-        if not boat:
-            not_found = {"Error" : "No boat with this boat_id exists"}
-            return Response(json.dumps(not_found), status= 404)
-        if boat["owner"] != owner:
-            wrong_owner = {"Error" : "The boat with this id has a different owner"}
-            return Response(json.dumps(wrong_owner), status= 403)
-        # if missing required attribute, 400 status code returned
-        if len(content.items()) < 3:
-            bad_request = {"Error" : "The request object is missing at least one of the required attributes"}
-            return Response(json.dumps(bad_request), status= 400)
-        boat.update({'name': content['name'], 'type': content['type'],
-          'length': content['length']})
-        client.put(boat)
-        boat["id"] = boat.key.id
-        boat["self"] = request.url_root + "boats/" + str(boat["id"])
-        return Response(json.dumps(boat), status= 200)
+        # the boat is read from Datastore in the same transaction as the
+        # write, a cached copy could undo another instance's write
+        for attempt in transactions.attempts(client):
+            with attempt:
+                boat = client.get(boat_key)
+                # if invalid id, 404 status code
+                if not boat:
+                    not_found = {"Error" : "No boat with this boat_id exists"}
+                    return Response(json.dumps(not_found), status= 404)
+                if boat["owner"] != owner:
+                    wrong_owner = {"Error" : "The boat with this id has a different owner"}
+                    return Response(json.dumps(wrong_owner), status= 403)
+                if not etag.matches(request, boat):
+                    return etag.precondition_failed_response()
+                # if missing required attribute, 400 status code returned
+                error = validate_boat(content)
+                if error:
+                    bad_request = {"Error" : error}
+                    return Response(json.dumps(bad_request), status= 400)
+                renamed = boat["name"] != content['name']
+                # only the client's properties are replaced, the aggregates and
+                # owner in the body (e.g. of a fetched boat) are ignored
+                boat.update({'name': content['name'], 'type': content['type'],
+                  'length': content['length']})
+                client.put(boat)
+                # the name is copied into the carrier of the boat's loads by
+                # a job committed with the rename
+                staged = jobs.queue.stage(jobs.carrier_name_jobs(boat.key.id)) if renamed else []
+        cache.refresh(boat)
+        jobs.queue.release(staged)
+        response = Response(responses.dumps(responses.boat_view(boat, request.url_root)), status= 200)
+        response.set_etag(etag.entity_etag(boat))
+        return response
     elif request.method == 'PATCH':
         # if request is not JSON, 415 status returned
         if 'application/json' not in request.content_type:
@@ -128,54 +244,63 @@ def boats_put_delete(id):
         owner = payload["sub"]
         content = request.get_json()
         boat_key = client.key(constants.boats, int(id))
-        boat = client.get(key=boat_key)
-        # if invalid id, 404 status code
-        if not boat:
-            not_found = {"Error" : "No boat with this boat_id exists"}
-            return Response(json.dumps(not_found), status= 404)
-        if boat["owner"] != owner:
-            wrong_owner = {"Error" : "The boat with this id has a different owner"}
-            return Response(json.dumps(wrong_owner), status= 403)
-        # if missing required attribute, 400 status code returned
-        if len(content.items()) < 1:
-            bad_request = {"Error" : "The request object is empty"}
-            return Response(json.dumps(bad_request), status= 400)
-        boat.update(content)
-        client.put(boat)
-        boat["id"] = boat.key.id
-        boat["self"] = request.url_root + "boats/" + str(boat["id"])
-        return Response(json.dumps(boat), status= 200)
+        # the boat is read from Datastore in the same transaction as the
+        # write, a cached copy could undo another instance's write
+        for attempt in transactions.attempts(client):
+            with attempt:
+                boat = client.get(boat_key)
+                # if invalid id, 404 status code
+                if not boat:
+                    not_found = {"Error" : "No boat with this boat_id exists"}
+                    return Response(json.dumps(not_found), status= 404)
+                if boat["owner"] != owner:
+                    wrong_owner = {"Error" : "The boat with this id has a different owner"}
+                    return Response(json.dumps(wrong_owner), status= 403)
+                if not etag.matches(request, boat):
+                    return etag.precondition_failed_response()
+                # if empty or setting a read-only property, 400 status code returned
+                error = validate_patch(content)
+                if error:
+                    bad_request = {"Error" : error}
+                    return Response(json.dumps(bad_request), status= 400)
+                renamed = 'name' in content and boat["name"] != content['name']
+                boat.update(content)
+                client.put(boat)
+                # the name is copied into the carrier of the boat's loads by
+                # a job committed with the rename
+                staged = jobs.queue.stage(jobs.carrier_name_jobs(boat.key.id)) if renamed else []
+        cache.refresh(boat)
+        jobs.queue.release(staged)
+        response = Response(responses.dumps(responses.boat_view(boat, request.url_root)), status= 200)
+        response.set_etag(etag.entity_etag(boat))
+        return response
     elif request.method == 'DELETE':
-        # verify user
-        payload = verify_jwt(request)
-        owner = payload["sub"]
+        # verify user while the boat is read
         key = client.key(constants.boats, int(id))
-        boat = client.get(key=key)
+        payload, boat = parallel.run(lambda: verify_jwt(request), lambda: client.get(key))
+        owner = payload["sub"]
         if not boat:
             not_found = {"Error" : "No boat with this boat_id exists"}
             return Response(json.dumps(not_found), status= 404)
         if boat["owner"] != owner:
             wrong_owner = {"Error" : "The boat with this id has a different owner"}
             return Response(json.dumps(wrong_owner), status= 403)
-        # check if boat has loads, update loads' carrier before deleting boat
-        for l in boat["loads"]:
-            load_id = l["id"]
-            load_key = client.key(constants.loads, int(load_id))
-            load = client.get(key=load_key)
-            load["carrier"] = None
-            client.put(load)
-        client.delete(key)
+        # the boat's loads are detached by a job after the delete
+        delete_boats([boat], owner)
         return ('',204)
     elif request.method == 'GET':
         # if client does not accept response as JSON, 406 status returned
         if 'application/json' not in request.accept_mimetypes:
             not_json = {"Error" : "Accept header must accept response content type application/json"}
             return Response(json.dumps(not_json), status= 406)
-        # verify user
-        payload = verify_jwt(request)
-        owner = payload["sub"]
+        expand = request.args.get('expand')
+        if expand not in (None, 'loads'):
+            bad_request = {"Error" : "Only loads can be expanded"}
+            return Response(json.dumps(bad_request), status= 400)
+        # verify user while the boat is read
         boat_key = client.key(constants.boats, int(id))
-        boat = client.get(key=boat_key)
+        payload, boat = parallel.run(lambda: verify_jwt(request), lambda: cache.get(client, boat_key))
+        owner = payload["sub"]
         # if invalid id, 404 status code
         if not boat:
             not_found = {"Error" : "No boat with this boat_id exists"}
@@ -183,72 +308,79 @@ def boats_put_delete(id):
         if boat["owner"] != owner:
             wrong_owner = {"Error" : "The boat with this id has a different owner"}
             return Response(json.dumps(wrong_owner), status= 403)
-        boat["id"] = boat.key.id
-        boat["self"] = request.url_root + "boats/" + str(boat["id"])
-        for load in boat["loads"]:
-            if load:
-                load["self"] = request.url_root + "loads/" + str(load["id"])
-        return Response(json.dumps(boat), status= 200)
+        if expand:
+            # the body depends on the loads too, so tag the body instead
+            view = expand_loads([boat], request.url_root)[0]
+            return etag.conditional(request, Response(responses.dumps(view), status= 200))
+        # the client's copy is still current, skip building the body
+        tag = etag.entity_etag(boat)
+        if etag.not_modified(request, tag):
+            return etag.not_modified_response(tag)
+        # like the other boat responses it leaves out the loads, which are
+        # listed by /boats/<id>/loads or ?expand=loads
+        response = Response(responses.dumps(responses.boat_view(boat, request.url_root)), status= 200)
+        response.set_etag(tag)
+        return response
     else:
         return 'Method not recognized'
 
+# Read a boat and a load with one lookup
+def get_boat_and_load(bid, lid):
+    boat_key = client.key(constants.boats, int(bid))
+    load_key = client.key(constants.loads, int(lid))
+    found = {e.key: e for e in batch.get_multi(client, [boat_key, load_key])}
+    return found.get(boat_key), found.get(load_key)
+
 @bp.route('/<bid>/loads/<lid>', methods=['PUT','DELETE'])
 def add_delete_load(bid,lid):
     if request.method == 'PUT':
-        # verify user
-        payload = verify_jwt(request)
-        owner = payload["sub"]
-        boat_key = client.key(constants.boats, int(bid))
-        boat = client.get(key=boat_key)
-        load_key = client.key(constants.loads, int(lid))
-        load = client.get(key=load_key)
-        if not load or not boat:
-            not_found = {"Error" : "The specified boat and/or load does not exist"}
-            return Response(json.dumps(not_found), status= 404)
-        if load["carrier"]:
-            already_loaded = {"Error" : "The load is already loaded on another boat"}
-            return Response(json.dumps(already_loaded), status= 403)
-        if boat["owner"] != owner:
-            wrong_owner = {"Error" : "The boat with this id has a different owner"}
-            return Response(json.dumps(wrong_owner), status= 403)
-        # add load to boat's load list
-        if 'loads' in boat.keys():
-            boat['loads'].append({"id": load.id})
-        else:
-            boat['loads'] = [{"id": load.id}]
-        # add specified boat to load
-        load["carrier"] = {"id": boat.id, "name": boat["name"]}
-        client.put_multi([boat, load])
+        # verify user on the pool; the reads belong to the transaction, so
+        # they stay on this thread
+        auth = parallel.submit(verify_jwt, request)
+        # the load's carrier and the boat's aggregates are read and written in
+        # one transaction, retried if a concurrent request commits a change to
+        # either first
+        for attempt in transactions.attempts(client):
+            with attempt:
+                boat, load = get_boat_and_load(bid, lid)
+                owner = auth.result()["sub"]
+                if not load or not boat:
+                    not_found = {"Error" : "The specified boat and/or load does not exist"}
+                    return Response(json.dumps(not_found), status= 404)
+                if load["carrier"]:
+                    already_loaded = {"Error" : "The load is already loaded on another boat"}
+                    return Response(json.dumps(already_loaded), status= 403)
+                if boat["owner"] != owner:
+                    wrong_owner = {"Error" : "The boat with this id has a different owner"}
+                    return Response(json.dumps(wrong_owner), status= 403)
+                # add specified boat to load, the boat only keeps counts
+                load["carrier"] = {"id": boat.id, "name": boat["name"]}
+                aggregates.add(boat, load)
+                client.put_multi([boat, load])
+        cache.refresh(boat, load)
         return('',204)
     elif request.method == 'DELETE':
-        # verify user
-        payload = verify_jwt(request)
-        owner = payload["sub"]
-        boat_key = client.key(constants.boats, int(bid))
-        boat = client.get(key=boat_key)
-        load_key = client.key(constants.loads, int(lid))
-        load = client.get(key=load_key)
-        if not load or not boat:
-            not_found = {"Error" : "No boat with this boat_id is loaded with the load with this load_id"}
-            return Response(json.dumps(not_found), status= 404)
-        if boat["owner"] != owner:
-            wrong_owner = {"Error" : "The boat with this id has a different owner"}
-            return Response(json.dumps(wrong_owner), status= 403)
-        load_present = False
-        for l in boat["loads"]:
-            if l and l["id"] == load.id:
-                load_present = True
-                break
-        if not load_present:
-            not_present = {"Error" : "No boat with this boat_id is loaded with the load with this load_id"}
-            return Response(json.dumps(not_present), status= 404)
-        # remove load from boat's load list
-        for l in boat["loads"]:
-            if l and l["id"] == load.id:
-                boat['loads'].remove(l)
-        # remove boat from load's specified carrier
-        load["carrier"] = None
-        client.put_multi([boat, load])
+        # verify user while the transaction reads
+        auth = parallel.submit(verify_jwt, request)
+        for attempt in transactions.attempts(client):
+            with attempt:
+                boat, load = get_boat_and_load(bid, lid)
+                owner = auth.result()["sub"]
+                if not load or not boat:
+                    not_found = {"Error" : "No boat with this boat_id is loaded with the load with this load_id"}
+                    return Response(json.dumps(not_found), status= 404)
+                if boat["owner"] != owner:
+                    wrong_owner = {"Error" : "The boat with this id has a different owner"}
+                    return Response(json.dumps(wrong_owner), status= 403)
+                # the load's carrier says which boat it is on
+                if not load["carrier"] or load["carrier"]["id"] != boat.id:
+                    not_present = {"Error" : "No boat with this boat_id is loaded with the load with this load_id"}
+                    return Response(json.dumps(not_present), status= 404)
+                # remove boat from load's specified carrier
+                load["carrier"] = None
+                aggregates.remove(boat, load)
+                client.put_multi([boat, load])
+        cache.refresh(boat, load)
         return('',204)
     else:
         return 'Method not recognized'
@@ -260,39 +392,161 @@ def get_loads(id):
         if 'application/json' not in request.accept_mimetypes:
             not_json = {"Error" : "Accept header must accept response content type application/json"}
             return Response(json.dumps(not_json), status= 406)
-        # verify user
-        payload = verify_jwt(request)
-        owner = payload["sub"]
+        try:
+            fields = fieldsets.parse(request, constants.loads)
+        except fieldsets.FieldsError as e:
+            bad_request = {"Error" : e.message}
+            return Response(json.dumps(bad_request), status= 400)
         boat_key = client.key(constants.boats, int(id))
-        boat = client.get(key=boat_key)
+        query = client.query(kind=constants.loads)
+        query.add_filter("carrier.id", "=", int(id))
+        # read only the requested properties when an index allows it
+        projected = fieldsets.projection("boat_loads", fields)
+        if projected:
+            query.projection = projected
+        # the page is read while the user is verified and the boat is read,
+        # and only returned once both checks passed
+        page = parallel.submit(pagination.fetch_page, query, request)
+        payload, boat = parallel.run(lambda: verify_jwt(request), lambda: cache.get(client, boat_key))
+        owner = payload["sub"]
         if not boat:
             not_found = {"Error" : "No boat with this boat_id exists"}
             return Response(json.dumps(not_found), status= 404)
         if boat["owner"] != owner:
             wrong_owner = {"Error" : "The boat with this id has a different owner"}
             return Response(json.dumps(wrong_owner), status= 403)
-        query = client.query(kind=constants.loads)
-        query.add_filter("carrier.id", "=", int(id))
-        q_limit = int(request.args.get('limit', '5'))
-        q_offset = int(request.args.get('offset', '0'))
-        l_iterator = query.fetch(limit= q_limit, offset=q_offset)
-        pages = l_iterator.pages
-        results = list(next(pages))
-        if l_iterator.next_page_token:
-            next_offset = q_offset + q_limit
-            next_url = request.base_url + "?limit=" + str(q_limit) + "&offset=" + str(next_offset)
-        else:
-            next_url = None
-        for e in results:
-            e["id"] = e.key.id
-            e["self"] = request.url_root + "loads/" + str(e["id"])
-            carrier = e["carrier"]
-            if carrier:
-                carrier["self"] = request.url_root + "boats/" + str(carrier["id"])
+        try:
+            results, next_url = page.result()
+        except pagination.PaginationError as e:
+            bad_request = {"Error" : e.message}
+            return Response(json.dumps(bad_request), status= 400)
+        results = [responses.load_view(e, request.url_root) for e in results]
+        if fields:
+            results = [fieldsets.select(e, fields) for e in results]
         output = {"loads": results}
         if next_url:
             output["next"] = next_url
-        return Response(json.dumps(output), status= 200)
+        return etag.conditional(request, Response(responses.dumps(output), status= 200))
     else:
         return 'Method not recognized'
-    
+
+
+@batch_bp.route('/boats:batch', methods=['POST', 'GET', 'DELETE'])
+def boats_batch():
+    # if client does not accept response as JSON, 406 status returned
+    if 'application/json' not in request.accept_mimetypes:
+        not_json = {"Error" : "Accept header must accept response content type application/json"}
+        return Response(json.dumps(not_json), status= 406)
+    if request.method == 'POST':
+        # if request is not JSON, 415 status returned
+        if not request.content_type or 'application/json' not in request.content_type:
+            not_json = {"Error" : "Request must be content type application/json"}
+            return Response(json.dumps(not_json), status= 415)
+    # verify user; reads and deletes look up their boats meanwhile
+    auth = parallel.submit(verify_jwt, request)
+    if request.method == 'POST':
+        owner = auth.result()["sub"]
+        content = request.get_json()
+        if not isinstance(content, list) or len(content) > constants.max_batch_items:
+            bad_request = {"Error" : "The request must be a list of at most " + str(constants.max_batch_items) + " boats"}
+            return Response(json.dumps(bad_request), status= 400)
+        results = [None] * len(content)
+        new_boats = []
+        for i, item in enumerate(content):
+            error = validate_boat(item)
+            if error:
+                results[i] = {"status": 400, "Error": error}
+            else:
+                new_boats.append((i, item))
+        # ids for the whole batch are allocated in one call
+        keys = client.allocate_ids(client.key(constants.boats), len(new_boats)) if new_boats else []
+        entities = []
+        for key, (i, item) in zip(keys, new_boats):
+            new_boat = datastore.entity.Entity(key=key)
+            new_boat.update({'name': item['name'], 'type': item['type'],
+              'length': item['length'], "owner": owner,
+              'load_count': 0, 'total_volume': 0})
+            entities.append((i, new_boat))
+        for chunk in batch.chunks(entities, constants.transaction_batch_size):
+            # earlier chunks are already committed, so a chunk that still
+            # conflicts after its retries only fails its own items
+            try:
+                for attempt in transactions.attempts(client):
+                    with attempt:
+                        client.put_multi([e for i, e in chunk])
+                        counter.increment(client, counter.boats_counter(owner), len(chunk))
+            except exceptions.Conflict:
+                for i, new_boat in chunk:
+                    results[i] = {"status": 409, "Error": "The request conflicted with concurrent changes, try again"}
+                continue
+            cache.refresh(*[e for i, e in chunk])
+            for i, new_boat in chunk:
+                results[i] = {"status": 201, "boat": responses.boat_view(new_boat, request.url_root)}
+        return Response(responses.dumps({"results": results}), status= 200)
+    try:
+        ids = batch.parse_ids(request)
+    except batch.BatchError as e:
+        # an unauthenticated request still gets its 401 first
+        auth.result()
+        bad_request = {"Error" : e.message}
+        return Response(json.dumps(bad_request), status= 400)
+    results = batch.id_results(ids)
+    found = {}
+    keys = [client.key(constants.boats, i) for i in set(ids) if i is not None]
+    for boat in batch.get_multi(client, keys):
+        found[boat.key.id] = boat
+    owner = auth.result()["sub"]
+    for i, boat_id in enumerate(ids):
+        if boat_id is None:
+            continue
+        boat = found.get(boat_id)
+        if not boat:
+            results[i] = {"status": 404, "Error": "No boat with this boat_id exists"}
+        elif boat["owner"] != owner:
+            results[i] = {"status": 403, "Error": "The boat with this id has a different owner"}
+    owned = [boat for boat in found.values() if boat["owner"] == owner]
+    if request.method == 'GET':
+        views = {boat.key.id: responses.boat_view(boat, request.url_root) for boat in owned}
+        for i, boat_id in enumerate(ids):
+            if results[i] is None:
+                results[i] = {"status": 200, "boat": views[boat_id]}
+        return Response(responses.dumps({"results": results}), status= 200)
+    elif request.method == 'DELETE':
+        # the boats' loads are detached by jobs after the delete
+        for chunk in batch.chunks(owned, constants.transaction_batch_size):
+            delete_boats(chunk, owner)
+        deleted = set()
+        for i, boat_id in enumerate(ids):
+            if results[i] is not None:
+                continue
+            # a repeated id is only deleted once
+            if boat_id in deleted:
+                results[i] = {"status": 404, "Error": "No boat with this boat_id exists"}
+            else:
+                results[i] = {"status": 204, "id": boat_id}
+                deleted.add(boat_id)
+        return Response(responses.dumps({"results": results}), status= 200)
+    else:
+        return 'Method not recognized'
+
+
+@bp.route('/<id>/summary', methods=['GET'])
+def boat_summary(id):
+    # if client does not accept response as JSON, 406 status returned
+    if 'application/json' not in request.accept_mimetypes:
+        not_json = {"Error" : "Accept header must accept response content type application/json"}
+        return Response(json.dumps(not_json), status= 406)
+    # verify user while the boat is read
+    boat_key = client.key(constants.boats, int(id))
+    payload, boat = parallel.run(lambda: verify_jwt(request), lambda: cache.get(client, boat_key))
+    owner = payload["sub"]
+    if not boat:
+        not_found = {"Error" : "No boat with this boat_id exists"}
+        return Response(json.dumps(not_found), status= 404)
+    if boat["owner"] != owner:
+        wrong_owner = {"Error" : "The boat with this id has a different owner"}
+        return Response(json.dumps(wrong_owner), status= 403)
+    output = aggregates.summary(boat)
+    output["id"] = boat.key.id
+    output["self"] = request.url_root + "boats/" + str(boat.key.id)
+    return etag.conditional(request, Response(responses.dumps(output), status= 200))
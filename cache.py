@@ -0,0 +1,140 @@
+from collections import OrderedDict
+from google.cloud import datastore
+import copy
+import threading
+import time
+import constants
+
+# Read-through cache of boat and load entities keyed by their Datastore key.
+# Handlers read through get/get_multi and call set or invalidate after every
+# write. Entities are copied on the way in and out, so handlers can add
+# id/self links to what they get back without touching the cached value.
+
+
+# Bounded LRU with a per-entry TTL. Any object with the same get/set/delete/
+# clear methods can be used instead, e.g. a shared cache.
+class MemoryBackend:
+    def __init__(self, maxsize=constants.entity_cache_size, ttl=constants.entity_cache_ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class EntityCache:
+    def __init__(self, backend=None):
+        self.backend = backend if backend is not None else MemoryBackend()
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def _count(self, hits, misses):
+        with self._lock:
+            self.hits += hits
+            self.misses += misses
+
+    def get(self, client, key):
+        found = self.get_multi(client, [key])
+        return found[0] if found else None
+
+    # Like client.get_multi, missing entities are left out of the result
+    def get_multi(self, client, keys):
+        # reads inside a transaction must come from the datastore
+        if client.current_transaction is not None:
+            return client.get_multi(keys)
+        found = []
+        missing = []
+        for key in keys:
+            entity = self.backend.get(_cache_key(key))
+            if entity is None:
+                missing.append(key)
+            else:
+                found.append(_copy(entity))
+        self._count(len(keys) - len(missing), len(missing))
+        if missing:
+            for entity in client.get_multi(missing):
+                self.backend.set(_cache_key(entity.key), _copy(entity))
+                found.append(entity)
+        return found
+
+    # Store the written state of entities, call right after they are put
+    def set(self, entities):
+        for entity in entities:
+            self.backend.set(_cache_key(entity.key), _copy(entity))
+
+    def invalidate(self, keys):
+        for key in keys:
+            self.backend.delete(_cache_key(key))
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            stats = {"hits": self.hits, "misses": self.misses,
+                     "hit_ratio": self.hits / lookups if lookups else 0.0}
+        if hasattr(self.backend, "__len__"):
+            stats["size"] = len(self.backend)
+        return stats
+
+    def clear(self):
+        self.backend.clear()
+        with self._lock:
+            self.hits = 0
+            self.misses = 0
+
+
+def _cache_key(key):
+    return (key.project, key.namespace, key.flat_path)
+
+
+def _copy(entity):
+    result = datastore.Entity(key=entity.key, exclude_from_indexes=tuple(entity.exclude_from_indexes))
+    result.update(copy.deepcopy(dict(entity)))
+    return result
+
+
+entities = EntityCache()
+
+
+def get(client, key):
+    return entities.get(client, key)
+
+
+def get_multi(client, keys):
+    return entities.get_multi(client, keys)
+
+
+def refresh(*written):
+    entities.set(written)
+
+
+def invalidate(keys):
+    entities.invalidate(keys)
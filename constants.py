@@ -1,2 +1,92 @@
 boats = "boats"
-loads = "loads"
\ No newline at end of file
+loads = "loads"
+users = "users"
+counters = "counters"
+sessions = "sessions"
+jobs = "jobs"
+# number of shards each counter is split into to spread write contention
+counter_shards = 20
+
+# page size used when a list request has no limit, and the largest allowed
+default_limit = 5
+max_limit = 100
+# loads listed per boat by ?expand=loads, and boats whose loads are read by
+# one query (an IN filter takes at most 30 values)
+expand_loads_limit = 100
+expand_boats_per_query = 30
+
+# largest number of keys or entities sent in one get_multi/put_multi/delete_multi
+batch_size = 500
+# most items accepted by one :batch request
+max_batch_items = 1000
+# entities a :batch request writes per transaction. A commit holds at most
+# 500 mutations, and each transaction also writes a counter shard and, for
+# loads, up to one carrier per load or, for deleted boats, one job per boat.
+transaction_batch_size = 200
+
+# entities kept by the in-process entity cache, and seconds each entry lives
+entity_cache_size = 10000
+entity_cache_ttl = 30
+
+# entities read per Datastore query page while streaming an export
+export_page_size = 500
+
+# attempts made at a transaction that fails on contention, and the backoff
+# in seconds before the first retry (doubled each retry, at most the cap)
+transaction_attempts = 5
+transaction_backoff = 0.05
+transaction_backoff_cap = 1.0
+
+# write-behind job queue: worker threads, jobs claimed per batch, attempts
+# before a job is given up on, seconds a claimed job is leased to its worker,
+# and seconds an idle worker waits before polling again
+job_workers = 2
+job_batch_size = 50
+job_max_attempts = 5
+job_lease = 60
+job_poll_interval = 1.0
+# queue depth and lag reported by /metrics: seconds they are reused for, and
+# the most jobs the Datastore backend counts
+job_stats_ttl = 5.0
+job_depth_limit = 1000
+
+# server-side sessions: seconds a session lives after it was last written,
+# and sessions kept by the in-process backend
+session_ttl = 86400
+session_cache_size = 10000
+# sessions the Datastore backend keeps in process after reading them, and
+# the seconds each is kept; a session deleted on another instance is still
+# found here until then
+session_read_cache_size = 10000
+session_read_cache_ttl = 10
+
+# subs of users known to exist, remembered by the login callback, and the
+# seconds each is remembered
+known_users_size = 10000
+known_users_ttl = 3600
+
+# threads shared by all requests for running their independent I/O calls
+# concurrently
+parallel_workers = 16
+
+# response compression: bodies smaller than compress_min_size bytes are sent
+# as they are, larger ones are compressed at zlib level compress_level
+compress_min_size = 1024
+compress_level = 6
+
+# admission control: tokens each caller's bucket refills per second and holds
+# at most, buckets kept in memory, and requests running at once before more
+# are shed
+ratelimit_rate = 10
+ratelimit_burst = 60
+ratelimit_buckets = 100000
+max_concurrent_requests = 64
+# proxies in front of the app whose X-Forwarded-For entries are trusted for
+# the client's address. On App Engine the address comes from the front end's
+# X-Appengine-User-Ip instead.
+trusted_proxies = 0
+
+# bulk import: records written per transaction, which also holds the
+# counter and up to as many carriers, and chunks written at once
+import_chunk_size = 200
+import_workers = 4
@@ -0,0 +1,99 @@
+from google.cloud import datastore
+import random
+import constants
+import transactions
+
+# Sharded counters stored in the counters kind. Each counter is split into
+# constants.counter_shards entities named "<counter>#<n>" so concurrent
+# writers rarely touch the same entity. Writers only ever touch the one shard
+# they add to, creating it if needed. A counter's value is the count of its
+# "<counter>#base" entity plus its shards; the base is written when the
+# counter is first read, from a count of the entities, so a missing base
+# means "never counted yet".
+
+
+def loads_counter():
+    return constants.loads
+
+
+def boats_counter(owner):
+    return constants.boats + "|" + owner
+
+
+def _shard_key(client, name, index):
+    return client.key(constants.counters, name + "#" + str(index))
+
+
+def _shard_keys(client, name):
+    return [_shard_key(client, name, i) for i in range(constants.counter_shards)]
+
+
+def _base_key(client, name):
+    return _shard_key(client, name, "base")
+
+
+# Add delta to a random shard of the counter. Call this inside the same
+# transaction that writes or deletes the counted entity.
+def increment(client, name, delta):
+    shard_key = _shard_key(client, name, random.randrange(constants.counter_shards))
+    shard = client.get(shard_key)
+    if shard is None:
+        shard = datastore.Entity(key=shard_key)
+        shard["count"] = 0
+    shard["count"] += delta
+    client.put(shard)
+
+
+# Count the entities matched by query without loading them
+def count_query(query):
+    query.keys_only()
+    return sum(1 for _ in query.fetch())
+
+
+# Set the counter to a count of query, returning the count. The shards are
+# read in the same transaction as the count and the base is written so that
+# base plus shards equals it; an increment committed meanwhile changes a
+# shard that was read, so the transaction is retried instead of losing it.
+def seed(client, name, query):
+    keys = _shard_keys(client, name)
+    for attempt in transactions.attempts(client):
+        with attempt:
+            shards = client.get_multi(keys)
+            total = count_query(query)
+            base = datastore.Entity(key=_base_key(client, name))
+            base["count"] = total - sum(s.get("count", 0) for s in shards)
+            client.put(base)
+    return total
+
+
+# Return the counter's value. When the counter has never been initialised,
+# fall back to a keys-only count of query and seed the counter with it.
+def count(client, name, query):
+    found = client.get_multi([_base_key(client, name)] + _shard_keys(client, name))
+    if not any(e.key.name == _base_key(client, name).name for e in found):
+        return seed(client, name, query)
+    return sum(e.get("count", 0) for e in found)
+
+
+# The query a counter counts
+def _query(client, name):
+    if name == loads_counter():
+        return client.query(kind=constants.loads)
+    query = client.query(kind=constants.boats)
+    query.add_filter("owner", "=", name.split("|", 1)[1])
+    return query
+
+
+# Recompute every counter from the datastore, returning {name: total}
+def repair(client):
+    names = set([loads_counter()])
+    query = client.query(kind=constants.boats)
+    query.projection = ["owner"]
+    for boat in query.fetch():
+        names.add(boats_counter(boat["owner"]))
+    # owners whose boats have all been deleted go back to zero
+    query = client.query(kind=constants.counters)
+    query.keys_only()
+    for e in query.fetch():
+        names.add(e.key.name.rsplit("#", 1)[0])
+    return {name: seed(client, name, _query(client, name)) for name in names}
@@ -0,0 +1,36 @@
+from google.cloud import datastore
+import threading
+import metrics
+
+# The one Datastore client shared by every blueprint. It is created on first
+# use rather than at import, so a cold start does not pay for credential
+# discovery and channel setup before it can serve a request that needs
+# neither, and every request reuses the same pooled gRPC channel.
+
+_client = None
+_lock = threading.Lock()
+
+
+def get_client():
+    global _client
+    if _client is None:
+        with _lock:
+            if _client is None:
+                _client = metrics.instrument(datastore.Client())
+    return _client
+
+
+# Use client (e.g. one pointed at the emulator or an in-memory stand-in)
+# instead of creating the default one
+def set_client(client):
+    global _client
+    with _lock:
+        _client = metrics.instrument(client)
+
+
+class LazyClient:
+    def __getattr__(self, name):
+        return getattr(get_client(), name)
+
+
+client = LazyClient()
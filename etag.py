@@ -0,0 +1,58 @@
+from flask import Response
+import hashlib
+import json
+
+# Strong ETags for boats and loads. A single resource's tag is a hash of the
+# stored entity, so it can be checked against the entity the handler already
+# fetched; list responses are tagged with a hash of their body. A compressed
+# response is a different representation and gets its tag with the coding as
+# a suffix (see coded); conditional requests accept either form.
+
+
+def entity_etag(entity):
+    data = json.dumps([list(entity.key.flat_path), entity], sort_keys=True, default=str)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()[:32]
+
+
+# The tag of a body that was tagged tag before it was compressed with coding
+def coded(tag, coding):
+    return tag + "-" + coding
+
+
+# True if etags (a parsed If-Match or If-None-Match) names tag, as it is or
+# with the suffix of a coding
+def names(etags, tag):
+    return etags.contains(tag) or any(t.rsplit("-", 1)[0] == tag for t in etags)
+
+
+# True if the client's If-None-Match already names tag
+def not_modified(request, tag):
+    return names(request.if_none_match, tag)
+
+
+def not_modified_response(tag):
+    response = Response(status= 304)
+    response.set_etag(tag)
+    return response
+
+
+# False if the request has an If-Match header that does not name entity's tag
+def matches(request, entity):
+    if not request.if_match:
+        return True
+    return names(request.if_match, entity_etag(entity))
+
+
+def precondition_failed_response():
+    failed = {"Error" : "The resource has been modified since it was last fetched"}
+    return Response(json.dumps(failed), status= 412)
+
+
+# Tag a list response with a hash of its body and turn it into a 304 when the
+# client already has that body
+def conditional(request, response):
+    response.add_etag()
+    tag, weak = response.get_etag()
+    if not_modified(request, tag):
+        return not_modified_response(tag)
+    return response
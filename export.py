@@ -0,0 +1,87 @@
+from flask import Blueprint, request, Response, stream_with_context
+from google.api_core.exceptions import BadRequest
+import binascii
+import json
+import constants
+from auth import verify_jwt
+from db import client
+import responses
+
+# Streaming NDJSON exports. Entities are read one query page at a time and
+# written out as they arrive, so memory use does not depend on the size of
+# the kind. After every page a {"next_cursor": ...} line is written; passing
+# that value back as ?cursor= resumes an interrupted export after that page.
+
+bp = Blueprint('export', __name__)
+
+
+# One page of query from cursor, and the cursor after it
+def _page(query, cursor):
+    iterator = query.fetch(limit=constants.export_page_size, start_cursor=cursor)
+    page = list(next(iterator.pages))
+    cursor = iterator.next_page_token
+    if isinstance(cursor, bytes):
+        cursor = cursor.decode("ascii")
+    return page, cursor
+
+
+def _pages(query, first):
+    page, cursor = first
+    while page:
+        yield page, cursor
+        if not cursor:
+            return
+        page, cursor = _page(query, cursor)
+
+
+def _lines(query, first, view):
+    encode = responses.encoder()
+    for page, next_cursor in _pages(query, first):
+        yield b"".join(encode(view(e)) + b"\n" for e in page)
+        if next_cursor:
+            yield encode({"next_cursor": next_cursor}) + b"\n"
+
+
+def _export(query, view):
+    # the first page is read before the response starts, so a bad cursor
+    # still gets a 400 instead of breaking the stream after a 200
+    try:
+        first = _page(query, request.args.get('cursor'))
+    except (binascii.Error, BadRequest):
+        bad_request = {"Error" : "The cursor is not valid"}
+        return Response(json.dumps(bad_request), status= 400)
+    # the response layer compresses the pages as they are written
+    chunks = _lines(query, first, view)
+    return Response(stream_with_context(chunks), status= 200, mimetype="application/x-ndjson")
+
+
+def _not_ndjson():
+    not_ndjson = {"Error" : "Accept header must accept response content type application/x-ndjson"}
+    return Response(json.dumps(not_ndjson), status= 406)
+
+
+@bp.route('/loads/export', methods=['GET'])
+def export_loads():
+    if 'application/x-ndjson' not in request.accept_mimetypes:
+        return _not_ndjson()
+    url_root = request.url_root
+    return _export(client.query(kind=constants.loads), lambda e: responses.load_view(e, url_root))
+
+
+@bp.route('/boats/export', methods=['GET'])
+def export_boats():
+    if 'application/x-ndjson' not in request.accept_mimetypes:
+        return _not_ndjson()
+    # verify user and export only the user's boats
+    payload = verify_jwt(request)
+    query = client.query(kind=constants.boats)
+    query.add_filter("owner", "=", payload["sub"])
+    url_root = request.url_root
+    return _export(query, lambda e: responses.boat_view(e, url_root))
+
+
+@bp.route('/users/export', methods=['GET'])
+def export_users():
+    if 'application/x-ndjson' not in request.accept_mimetypes:
+        return _not_ndjson()
+    return _export(client.query(kind=constants.users), responses.user_view)
@@ -0,0 +1,69 @@
+import itertools
+import constants
+
+# Sparse fieldsets for the list endpoints (?fields=id,name). When every
+# requested stored property is covered by a composite index in index.yaml the
+# page is read with a Datastore projection query, otherwise whole entities are
+# read and trimmed before they are serialized.
+
+
+class FieldsError(Exception):
+    def __init__(self, message):
+        self.message = message
+
+
+# fields a client can ask for, per kind
+ALLOWED = {
+    constants.boats: ("id", "self", "name", "type", "length", "owner", "loads", "load_count", "total_volume"),
+    constants.loads: ("id", "self", "volume", "item", "creation_date", "carrier"),
+}
+
+# the list queries that can be projected: their kind, equality filters and the
+# stored properties that may be projected. indexes.py writes an index for
+# every combination of these into index.yaml.
+PROJECTIONS = {
+    "boats": (constants.boats, ("owner",), ("length", "name", "type")),
+    "loads": (constants.loads, (), ("creation_date", "item", "volume")),
+    "boat_loads": (constants.loads, ("carrier.id",), ("creation_date", "item", "volume")),
+}
+
+# computed fields that do not come from a stored property
+COMPUTED = ("id", "self")
+
+
+def parse(request, kind):
+    if 'fields' not in request.args:
+        return None
+    fields = [f.strip() for f in request.args['fields'].split(',') if f.strip()]
+    if not fields:
+        raise FieldsError("fields must name at least one field")
+    for field in fields:
+        if field not in ALLOWED[kind]:
+            raise FieldsError("Unknown field " + field + ", use any of " + ", ".join(ALLOWED[kind]))
+    return fields
+
+
+# The properties to project for the named list query, or None if fields
+# can't be served by a projection
+def projection(name, fields):
+    if not fields:
+        return None
+    stored = sorted(set(f for f in fields if f not in COMPUTED))
+    if not stored or any(f not in PROJECTIONS[name][2] for f in stored):
+        return None
+    return stored
+
+
+# Copy of the rendered entity with only the requested fields
+def select(entity, fields):
+    return {f: entity[f] for f in fields if f in entity}
+
+
+# (kind, properties) of every composite index the projections need
+def composite_indexes():
+    for kind, filters, properties in PROJECTIONS.values():
+        for size in range(1, len(properties) + 1):
+            for combination in itertools.combinations(properties, size):
+                # single properties without filters use the built-in indexes
+                if filters or size > 1:
+                    yield kind, tuple(filters) + combination
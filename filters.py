@@ -0,0 +1,110 @@
+import itertools
+import constants
+
+# Server-side filtering and sorting for GET /loads. Only queries Datastore can
+# answer from an index are accepted: at most one property may have a range,
+# a sort must be on that property, and a range or sort combined with equality
+# filters needs one of the composite indexes listed in index.yaml (see
+# composite_indexes below). Anything else is rejected rather than scanned.
+
+
+class FilterError(Exception):
+    def __init__(self, message):
+        self.message = message
+
+
+# range arguments: property, lower bound argument, upper bound argument
+RANGES = (
+    ("volume", "volume_min", "volume_max"),
+    ("creation_date", "created_after", "created_before"),
+)
+SORTABLE = ("volume", "creation_date", "item")
+# equality filters that can be combined with a range or a sort
+EQUALITY_SETS = ((), ("item",), ("carrier",), ("carrier.id",), ("carrier", "item"), ("carrier.id", "item"))
+
+
+def _number(name, value):
+    try:
+        return int(value)
+    except ValueError:
+        try:
+            return float(value)
+        except ValueError:
+            raise FilterError(name + " must be a number")
+
+
+# The composite index a query needs, or None if built-in indexes are enough
+def required_index(equalities, order):
+    if order is None or not equalities:
+        return None
+    return tuple(sorted(equalities)) + (order,)
+
+
+# (kind, properties) of every composite index the load filters need, a
+# property starting with "-" is descending
+def composite_indexes():
+    for equalities in EQUALITY_SETS:
+        for prop, direction in itertools.product(SORTABLE, ("", "-")):
+            index = required_index(equalities, direction + prop)
+            if index and prop not in equalities:
+                yield constants.loads, index
+
+
+SUPPORTED_INDEXES = set(index for kind, index in composite_indexes())
+
+
+# Add the filters and sort order in the request's arguments to query.
+# Returns True if any filter was applied.
+def apply(query, request):
+    args = request.args
+    equalities = []
+    if 'item' in args:
+        query.add_filter("item", "=", args['item'])
+        equalities.append("item")
+    carrier = args.get('carrier')
+    if carrier == 'none':
+        query.add_filter("carrier", "=", None)
+        equalities.append("carrier")
+    elif carrier:
+        try:
+            query.add_filter("carrier.id", "=", int(carrier))
+        except ValueError:
+            raise FilterError("carrier must be none or a boat id")
+        equalities.append("carrier.id")
+    ranged = None
+    for prop, low, high in RANGES:
+        if low not in args and high not in args:
+            continue
+        if ranged:
+            raise FilterError("Only one of the volume and creation date ranges can be used at a time")
+        ranged = prop
+        # volume bounds are inclusive, creation date bounds are exclusive
+        if prop == "volume":
+            if low in args:
+                query.add_filter(prop, ">=", _number(low, args[low]))
+            if high in args:
+                query.add_filter(prop, "<=", _number(high, args[high]))
+        else:
+            if low in args:
+                query.add_filter(prop, ">", args[low])
+            if high in args:
+                query.add_filter(prop, "<", args[high])
+    order = None
+    sort = args.get('sort')
+    if sort:
+        prop = sort.lstrip('-')
+        if prop not in SORTABLE or sort.count('-') > 1:
+            raise FilterError("sort must be one of " + ", ".join(SORTABLE) + ", optionally prefixed with -")
+        if prop in equalities:
+            raise FilterError("Results can't be sorted on a property they are filtered to one value of")
+        if ranged and prop != ranged:
+            raise FilterError("Results filtered on a " + ranged + " range can only be sorted on " + ranged)
+        order = sort
+    elif ranged:
+        order = ranged
+    if order:
+        query.order = [order]
+    index = required_index(equalities, order)
+    if index and index not in SUPPORTED_INDEXES:
+        raise FilterError("This combination of filters and sort is not supported")
+    return bool(equalities or ranged)
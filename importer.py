@@ -0,0 +1,263 @@
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from google.cloud import datastore
+import csv
+import json
+import os
+import sys
+import threading
+import time
+import aggregates
+import cache
+import constants
+import counter
+import transactions
+from boat import validate_boat
+from load import validate_load
+
+# Bulk import of loads or boats from CSV or NDJSON, run through manage.py.
+# Records are read as a stream and validated with the same rules as the POST
+# handlers. They are written in chunks of constants.import_chunk_size, each in
+# its own transaction together with the counters and, for loads, the
+# aggregates of their carriers; up to `workers` chunks are written at once.
+#
+# Every written chunk is appended to a checkpoint file next to the input. If
+# an import stops or some chunks fail, running it again with the same file
+# skips the chunks already written. A chunk that committed just before the
+# process died, but was not yet recorded, is written again.
+
+FORMATS = {".csv": "csv", ".ndjson": "ndjson", ".jsonl": "ndjson"}
+# CSV columns read as numbers
+NUMERIC = ("volume", "length", "carrier")
+
+
+class ImporterError(Exception):
+    def __init__(self, message):
+        self.message = message
+
+
+def _number(value):
+    for parse in (int, float):
+        try:
+            return parse(value)
+        except ValueError:
+            pass
+    return value
+
+
+# (record number, record or None, error or None) for each record of path
+def read(path, format):
+    with open(path, newline="", encoding="utf-8") as f:
+        if format == "csv":
+            for n, row in enumerate(csv.DictReader(f), 1):
+                # empty cells are missing values, numeric columns are numbers
+                record = {k: _number(v) if k in NUMERIC else v for k, v in row.items() if k and v != ""}
+                yield n, record, None
+            return
+        n = 0
+        for line in f:
+            if not line.strip():
+                continue
+            n += 1
+            try:
+                yield n, json.loads(line), None
+            except ValueError:
+                yield n, None, "The record is not valid JSON"
+
+
+# Group records into numbered chunks of size records. Chunk numbers depend
+# only on the input, so a resumed import numbers them the same way.
+def chunks(records, size):
+    chunk = []
+    for record in records:
+        chunk.append(record)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+class Checkpoint:
+    def __init__(self, path, source, kind, chunk_size):
+        self.path = path
+        self.done = set()
+        self._lock = threading.Lock()
+        header = {"source": os.path.abspath(source), "size": os.path.getsize(source),
+                  "kind": kind, "chunk_size": chunk_size}
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                lines = [json.loads(line) for line in f if line.strip()]
+            if lines and lines[0] != header:
+                raise ImporterError("The checkpoint " + path + " belongs to another import, delete it to start over")
+            self.done = set(line["chunk"] for line in lines[1:])
+            self._file = open(path, "a", encoding="utf-8")
+            if not lines:
+                self._write(header)
+        else:
+            self._file = open(path, "a", encoding="utf-8")
+            self._write(header)
+
+    def _write(self, line):
+        self._file.write(json.dumps(line) + "\n")
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def record(self, chunk):
+        with self._lock:
+            self._write({"chunk": chunk})
+
+    def close(self):
+        self._file.close()
+
+
+def _boat_id(value):
+    return isinstance(value, int) and not isinstance(value, bool) and value > 0
+
+
+# Write the valid loads of a chunk. Carriers named by the loads are read with
+# one lookup and get the loads added to their aggregates in the same commit.
+# Returns the errors of loads whose carrier does not exist.
+def write_loads(client, records, owner=None):
+    carrier_ids = set(r["carrier"] for n, r in records if _boat_id(r.get("carrier")))
+    for attempt in transactions.attempts(client):
+        with attempt:
+            boats = {}
+            if carrier_ids:
+                boats = {b.key.id: b for b in client.get_multi([client.key(constants.boats, i) for i in carrier_ids])}
+            errors = []
+            loads = []
+            carriers = {}
+            for n, record in records:
+                load = datastore.Entity(key=client.key(constants.loads))
+                load.update({"volume": record["volume"], "item": record["item"],
+                             "creation_date": record["creation_date"], "carrier": None})
+                carrier = record.get("carrier")
+                if carrier is not None:
+                    boat = boats.get(carrier) if _boat_id(carrier) else None
+                    if boat is None:
+                        errors.append((n, "No boat with this boat_id exists"))
+                        continue
+                    load["carrier"] = {"id": boat.key.id, "name": boat["name"]}
+                    aggregates.add(boat, load)
+                    carriers[boat.key.id] = boat
+                loads.append(load)
+            carriers = list(carriers.values())
+            client.put_multi(loads + carriers)
+            if loads:
+                counter.increment(client, counter.loads_counter(), len(loads))
+    cache.refresh(*carriers)
+    return len(loads), errors
+
+
+def write_boats(client, records, owner=None):
+    errors = []
+    boats = []
+    for n, record in records:
+        if not (record.get("owner") or owner):
+            errors.append((n, "The boat has no owner, give one with --owner"))
+            continue
+        boat = datastore.Entity(key=client.key(constants.boats))
+        boat.update({"name": record["name"], "type": record["type"], "length": record["length"],
+                     "owner": record.get("owner") or owner, "load_count": 0, "total_volume": 0})
+        boats.append(boat)
+    owners = {}
+    for boat in boats:
+        owners[boat["owner"]] = owners.get(boat["owner"], 0) + 1
+    for attempt in transactions.attempts(client):
+        with attempt:
+            client.put_multi(boats)
+            for name, total in owners.items():
+                counter.increment(client, counter.boats_counter(name), total)
+    return len(boats), errors
+
+
+KINDS = {
+    "loads": (validate_load, write_loads),
+    "boats": (validate_boat, write_boats),
+}
+
+
+class Progress:
+    def __init__(self, out, interval=1.0):
+        self.out = out
+        self.interval = interval
+        self.start = time.monotonic()
+        self.totals = {"records": 0, "imported": 0, "invalid": 0, "skipped": 0, "failed": 0}
+        self._printed = self.start
+        self._lock = threading.Lock()
+
+    def add(self, **counts):
+        with self._lock:
+            for name, value in counts.items():
+                self.totals[name] += value
+            now = time.monotonic()
+            if now - self._printed >= self.interval:
+                self._printed = now
+                self._print(now)
+
+    def error(self, n, message):
+        with self._lock:
+            print("record %d: %s" % (n, message), file=self.out)
+
+    def _print(self, now):
+        elapsed = now - self.start
+        print("%d records, %d imported, %d invalid, %.0f records/s" % (
+            self.totals["records"], self.totals["imported"], self.totals["invalid"],
+            # skipped records were not read from Datastore or written, so
+            # they do not count towards the rate
+            (self.totals["records"] - self.totals["skipped"]) / elapsed if elapsed else 0.0), file=self.out)
+
+    def finish(self):
+        with self._lock:
+            self._print(time.monotonic())
+            return dict(self.totals, seconds=round(time.monotonic() - self.start, 2))
+
+
+# Import the kind ("loads" or "boats") from path, returning the totals.
+# Boats without an owner column are given owner.
+def run(client, kind, path, format=None, owner=None, workers=constants.import_workers,
+        chunk_size=constants.import_chunk_size, checkpoint=None, out=sys.stderr):
+    if format is None:
+        format = FORMATS.get(os.path.splitext(path)[1].lower())
+        if format is None:
+            raise ImporterError("Can't tell the format of " + path + ", give it with --format")
+    validate, write = KINDS[kind]
+    checkpoint = Checkpoint(checkpoint or path + ".checkpoint", path, kind, chunk_size)
+    progress = Progress(out)
+
+    def work(number, records):
+        valid = []
+        for n, record, error in records:
+            error = error or validate(record)
+            if error:
+                progress.error(n, error)
+            else:
+                valid.append((n, record))
+        try:
+            imported, errors = write(client, valid, owner) if valid else (0, [])
+        except Exception as e:
+            for n, record, error in records:
+                progress.error(n, "not imported, chunk %d failed: %s" % (number, e))
+            progress.add(records=len(records), failed=len(records))
+            return
+        for n, error in errors:
+            progress.error(n, error)
+        checkpoint.record(number)
+        progress.add(records=len(records), imported=imported, invalid=len(records) - imported)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = set()
+        for number, records in enumerate(chunks(read(path, format), chunk_size)):
+            if number in checkpoint.done:
+                progress.add(records=len(records), skipped=len(records))
+                continue
+            # only a bounded number of chunks is held in memory
+            if len(pending) >= workers:
+                finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    future.result()
+            pending.add(pool.submit(work, number, records))
+        for future in pending:
+            future.result()
+    checkpoint.close()
+    return progress.finish()
@@ -0,0 +1,30 @@
+import itertools
+import fieldsets
+import filters
+import jobs
+
+# Write the composite indexes the queries in this app need, run with:
+#   python indexes.py > index.yaml
+# and deploy them with: gcloud datastore indexes create index.yaml
+
+
+def index_yaml():
+    lines = ["# generated by indexes.py", "indexes:"]
+    seen = set()
+    for kind, properties in itertools.chain(fieldsets.composite_indexes(), filters.composite_indexes(),
+                                             jobs.composite_indexes()):
+        if (kind, properties) in seen:
+            continue
+        seen.add((kind, properties))
+        lines.append("")
+        lines.append("- kind: " + kind)
+        lines.append("  properties:")
+        for prop in properties:
+            lines.append("  - name: " + prop.lstrip("-"))
+            if prop.startswith("-"):
+                lines.append("    direction: desc")
+    return "\n".join(lines) + "\n"
+
+
+if __name__ == '__main__':
+    print(index_yaml(), end="")
@@ -0,0 +1,562 @@
+from collections import OrderedDict
+from google.cloud import datastore
+import itertools
+import json
+import os
+import sqlite3
+import threading
+import time
+import batch
+import cache
+import constants
+import db
+import transactions
+
+# Write-behind queue for the secondary updates a request causes but does not
+# need to wait for: clearing the carrier of a deleted boat's loads, and copying
+# a renamed boat's name into its loads' carrier. Handlers stage their jobs in
+# the transaction of their own write; a pool of worker threads claims due jobs
+# in batches, runs them and retries failures with backoff. A job's id names
+# the work it does (e.g. "detach_loads:123"), so enqueueing the same work
+# again while it is pending is a no-op, and every job is safe to run more
+# than once.
+#
+# Jobs are stored in Datastore by default (kind jobs): they commit together
+# with the write that needs them and are run by whichever instance claims
+# them first. Set jobs_backend=memory to keep them in process, or jobs_db to
+# a file path to keep them in SQLite. Those backends can only take a job once
+# the write committed, so a crash in between loses it.
+
+
+def _job(job_id, kind, args, now):
+    return {"id": job_id, "kind": kind, "args": args, "attempts": 0,
+            "enqueued_at": now, "available_at": now}
+
+
+# Pending jobs in insertion order. Any object with the same put/claim/done/
+# retry/fail/retry_failed/depth/oldest methods can be used instead. A backend
+# whose transactional is True also has write, which adds jobs inside the
+# caller's Datastore transaction.
+class MemoryBackend:
+    transactional = False
+
+    def __init__(self):
+        self._pending = OrderedDict()
+        self._claimed = {}
+        self._requeue = set()
+        self._failed = {}
+        self._lock = threading.Lock()
+
+    # Add job unless a job with its id is already pending. A job with that id
+    # that is running is run again once it finishes.
+    def put(self, job):
+        with self._lock:
+            if job["id"] in self._pending:
+                return False
+            if job["id"] in self._claimed:
+                self._requeue.add(job["id"])
+                return False
+            self._pending[job["id"]] = job
+            return True
+
+    # Claim up to limit due jobs for lease seconds. Jobs whose lease ran out,
+    # e.g. because their worker died, can be claimed again.
+    def claim(self, limit, now, lease):
+        with self._lock:
+            for job_id, (job, expires) in list(self._claimed.items()):
+                if expires <= now:
+                    del self._claimed[job_id]
+                    self._pending[job_id] = job
+            claimed = []
+            for job in list(self._pending.values()):
+                if len(claimed) == limit:
+                    break
+                if job["available_at"] <= now:
+                    del self._pending[job["id"]]
+                    self._claimed[job["id"]] = (job, now + lease)
+                    claimed.append(job)
+            return claimed
+
+    def done(self, job, now):
+        with self._lock:
+            self._claimed.pop(job["id"], None)
+            if job["id"] in self._requeue:
+                self._requeue.discard(job["id"])
+                self._pending[job["id"]] = _job(job["id"], job["kind"], job["args"], now)
+
+    def retry(self, job, available_at):
+        with self._lock:
+            self._claimed.pop(job["id"], None)
+            self._requeue.discard(job["id"])
+            job = dict(job, attempts=job["attempts"] + 1, available_at=available_at)
+            self._pending[job["id"]] = job
+
+    def fail(self, job):
+        with self._lock:
+            self._claimed.pop(job["id"], None)
+            self._requeue.discard(job["id"])
+            self._failed[job["id"]] = job
+
+    # Make the failed jobs due again with fresh attempts, returning how many
+    def retry_failed(self, now):
+        with self._lock:
+            failed = list(self._failed.values())
+            self._failed.clear()
+            for job in failed:
+                if job["id"] not in self._pending and job["id"] not in self._claimed:
+                    self._pending[job["id"]] = _job(job["id"], job["kind"], job["args"], now)
+            return len(failed)
+
+    def depth(self):
+        with self._lock:
+            return len(self._pending) + len(self._claimed)
+
+    # enqueued_at of the oldest job not yet done, or None
+    def oldest(self):
+        with self._lock:
+            times = [job["enqueued_at"] for job in self._pending.values()]
+            times += [job["enqueued_at"] for job, expires in self._claimed.values()]
+            return min(times) if times else None
+
+
+# The same queue in a SQLite file, for a single instance that should not lose
+# pending jobs when it restarts
+class SqliteBackend:
+    transactional = False
+
+    def __init__(self, path):
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._lock = threading.Lock()
+        self._db.execute("""CREATE TABLE IF NOT EXISTS jobs (
+            id TEXT PRIMARY KEY, kind TEXT NOT NULL, args TEXT NOT NULL,
+            attempts INTEGER NOT NULL, enqueued_at REAL NOT NULL,
+            available_at REAL NOT NULL, state TEXT NOT NULL,
+            lease_until REAL, requeue INTEGER NOT NULL DEFAULT 0)""")
+        self._db.execute("CREATE INDEX IF NOT EXISTS jobs_due ON jobs (state, available_at)")
+
+    def _row(self, row):
+        return {"id": row[0], "kind": row[1], "args": json.loads(row[2]), "attempts": row[3],
+                "enqueued_at": row[4], "available_at": row[5]}
+
+    def put(self, job):
+        with self._lock:
+            row = self._db.execute("SELECT state FROM jobs WHERE id = ?", (job["id"],)).fetchone()
+            if row and row[0] == "pending":
+                return False
+            if row and row[0] == "claimed":
+                self._db.execute("UPDATE jobs SET requeue = 1 WHERE id = ?", (job["id"],))
+                return False
+            self._db.execute("INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, ?, ?, ?, 'pending', NULL, 0)",
+                             (job["id"], job["kind"], json.dumps(job["args"]), job["attempts"],
+                              job["enqueued_at"], job["available_at"]))
+            return True
+
+    def claim(self, limit, now, lease):
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                self._db.execute("UPDATE jobs SET state = 'pending' WHERE state = 'claimed' AND lease_until <= ?", (now,))
+                rows = self._db.execute("""SELECT id, kind, args, attempts, enqueued_at, available_at FROM jobs
+                    WHERE state = 'pending' AND available_at <= ? ORDER BY available_at LIMIT ?""", (now, limit)).fetchall()
+                self._db.executemany("UPDATE jobs SET state = 'claimed', lease_until = ? WHERE id = ?",
+                                     [(now + lease, row[0]) for row in rows])
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+            return [self._row(row) for row in rows]
+
+    def done(self, job, now):
+        with self._lock:
+            self._db.execute("""UPDATE jobs SET state = 'pending', attempts = 0, enqueued_at = ?,
+                available_at = ?, requeue = 0 WHERE id = ? AND requeue = 1""", (now, now, job["id"]))
+            self._db.execute("DELETE FROM jobs WHERE id = ? AND state = 'claimed'", (job["id"],))
+
+    def retry(self, job, available_at):
+        with self._lock:
+            self._db.execute("""UPDATE jobs SET state = 'pending', attempts = attempts + 1,
+                available_at = ?, requeue = 0 WHERE id = ?""", (available_at, job["id"]))
+
+    def fail(self, job):
+        with self._lock:
+            self._db.execute("UPDATE jobs SET state = 'failed', requeue = 0 WHERE id = ?", (job["id"],))
+
+    def retry_failed(self, now):
+        with self._lock:
+            return self._db.execute("""UPDATE jobs SET state = 'pending', attempts = 0, enqueued_at = ?,
+                available_at = ? WHERE state = 'failed'""", (now, now)).rowcount
+
+    def depth(self):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM jobs WHERE state != 'failed'").fetchone()[0]
+
+    def oldest(self):
+        with self._lock:
+            return self._db.execute("SELECT MIN(enqueued_at) FROM jobs WHERE state != 'failed'").fetchone()[0]
+
+
+# The queue as Datastore entities keyed by job id, shared by every instance.
+# Claims, retries and completions each run in a transaction, so two workers
+# never run the same claim. The queries over state need the indexes in
+# composite_indexes.
+class DatastoreBackend:
+    transactional = True
+
+    def _key(self, client, job_id):
+        return client.key(constants.jobs, job_id)
+
+    def _job(self, entity):
+        return {"id": entity.key.name, "kind": entity["kind"], "args": json.loads(entity["args"]),
+                "attempts": entity["attempts"], "enqueued_at": entity["enqueued_at"],
+                "available_at": entity["available_at"]}
+
+    # Add jobs in the caller's open transaction, so they commit or roll back
+    # with its writes. Jobs already pending are skipped, a claimed one is run
+    # again once it finishes. Returns how many were added.
+    def write(self, jobs):
+        client = db.get_client()
+        found = {e.key.name: e for e in client.get_multi([self._key(client, job["id"]) for job in jobs])}
+        written = {}
+        added = 0
+        for job in jobs:
+            entity = written.get(job["id"]) or found.get(job["id"])
+            if entity is not None and entity["state"] == "pending":
+                continue
+            if entity is not None and entity["state"] == "claimed":
+                entity["requeue"] = True
+            else:
+                entity = datastore.Entity(key=self._key(client, job["id"]), exclude_from_indexes=("args",))
+                entity.update({"kind": job["kind"], "args": json.dumps(job["args"]), "attempts": job["attempts"],
+                               "enqueued_at": job["enqueued_at"], "available_at": job["available_at"],
+                               "state": "pending", "lease_until": None, "requeue": False})
+                added += 1
+            written[job["id"]] = entity
+        client.put_multi(list(written.values()))
+        return added
+
+    def put(self, job):
+        client = db.get_client()
+        for attempt in transactions.attempts(client):
+            with attempt:
+                added = self.write([job])
+        return added == 1
+
+    # Due jobs, and claimed ones whose lease ran out, are claimed in one
+    # transaction; another worker that claimed one of them first aborts it.
+    def claim(self, limit, now, lease):
+        client = db.get_client()
+        expired = client.query(kind=constants.jobs)
+        expired.add_filter("state", "=", "claimed")
+        expired.add_filter("lease_until", "<=", now)
+        expired.keys_only()
+        due = client.query(kind=constants.jobs)
+        due.add_filter("state", "=", "pending")
+        due.add_filter("available_at", "<=", now)
+        due.order = ["available_at"]
+        due.keys_only()
+        keys = [e.key for e in expired.fetch(limit=limit)]
+        keys += [e.key for e in due.fetch(limit=limit - len(keys))] if len(keys) < limit else []
+        if not keys:
+            return []
+        for attempt in transactions.attempts(client):
+            with attempt:
+                claimed = []
+                for entity in client.get_multi(keys):
+                    if ((entity["state"] == "pending" and entity["available_at"] <= now)
+                            or (entity["state"] == "claimed" and entity["lease_until"] <= now)):
+                        entity.update({"state": "claimed", "lease_until": now + lease})
+                        claimed.append(entity)
+                client.put_multi(claimed)
+        return [self._job(entity) for entity in claimed]
+
+    # Read the job's entity in a transaction and write back what update
+    # returns: the entity, or None to delete it
+    def _update(self, job, update):
+        client = db.get_client()
+        key = self._key(client, job["id"])
+        for attempt in transactions.attempts(client):
+            with attempt:
+                entity = client.get(key)
+                if entity is None:
+                    return
+                entity = update(entity)
+                if entity is None:
+                    client.delete(key)
+                else:
+                    client.put(entity)
+
+    def done(self, job, now):
+        def update(entity):
+            if entity["requeue"]:
+                entity.update({"state": "pending", "attempts": 0, "enqueued_at": now, "available_at": now,
+                               "lease_until": None, "requeue": False})
+                return entity
+            return None if entity["state"] == "claimed" else entity
+        self._update(job, update)
+
+    def retry(self, job, available_at):
+        def update(entity):
+            entity.update({"state": "pending", "attempts": entity["attempts"] + 1, "available_at": available_at,
+                           "lease_until": None, "requeue": False})
+            return entity
+        self._update(job, update)
+
+    def fail(self, job):
+        def update(entity):
+            entity.update({"state": "failed", "requeue": False})
+            return entity
+        self._update(job, update)
+
+    def retry_failed(self, now):
+        client = db.get_client()
+        query = client.query(kind=constants.jobs)
+        query.add_filter("state", "=", "failed")
+        query.keys_only()
+        keys = [e.key for e in query.fetch()]
+        retried = 0
+        for chunk in batch.chunks(keys):
+            for attempt in transactions.attempts(client):
+                with attempt:
+                    failed = [e for e in client.get_multi(chunk) if e["state"] == "failed"]
+                    for entity in failed:
+                        entity.update({"state": "pending", "attempts": 0, "enqueued_at": now, "available_at": now})
+                    client.put_multi(failed)
+            retried += len(failed)
+        return retried
+
+    # Pending and claimed jobs, in enqueued_at order within each state when
+    # order is set
+    def _unfinished(self, order=False, limit=None):
+        client = db.get_client()
+        for state in ("pending", "claimed"):
+            query = client.query(kind=constants.jobs)
+            query.add_filter("state", "=", state)
+            if order:
+                query.order = ["enqueued_at"]
+            else:
+                query.keys_only()
+            yield from query.fetch(limit=limit)
+
+    # counted up to constants.job_depth_limit, so a long queue costs no more
+    # to report than that
+    def depth(self):
+        return sum(1 for _ in itertools.islice(self._unfinished(limit=constants.job_depth_limit),
+                                               constants.job_depth_limit))
+
+    def oldest(self):
+        times = [e["enqueued_at"] for e in self._unfinished(order=True, limit=1)]
+        return min(times) if times else None
+
+
+# (kind, properties) of the composite indexes DatastoreBackend queries with
+def composite_indexes():
+    yield constants.jobs, ("state", "lease_until")
+    yield constants.jobs, ("state", "available_at")
+    yield constants.jobs, ("state", "enqueued_at")
+
+
+# Clear the carrier of the loads of deleted boats
+def detach_loads(client, args):
+    boat_ids = set(a["boat_id"] for a in args)
+    load_keys = [key for keys in batch.carried_keys(client, boat_ids).values() for key in keys]
+    for chunk in batch.chunks(load_keys):
+        for attempt in transactions.attempts(client):
+            with attempt:
+                loads = batch.detach_loads(client, chunk, boat_ids)
+        cache.invalidate([load.key for load in loads])
+
+
+# Copy each boat's current name into the carrier of the loads it carries
+def carrier_names(client, args):
+    boat_keys = [client.key(constants.boats, a["boat_id"]) for a in args]
+    for boat in client.get_multi(boat_keys):
+        load_keys = batch.carried_keys(client, [boat.key.id])[boat.key.id]
+        for chunk in batch.chunks(load_keys):
+            for attempt in transactions.attempts(client):
+                with attempt:
+                    loads = [l for l in client.get_multi(chunk)
+                             if l.get("carrier") and l["carrier"]["id"] == boat.key.id and l["carrier"]["name"] != boat["name"]]
+                    for load in loads:
+                        load["carrier"]["name"] = boat["name"]
+                    client.put_multi(loads)
+            cache.invalidate([load.key for load in loads])
+
+
+HANDLERS = {
+    "detach_loads": detach_loads,
+    "carrier_name": carrier_names,
+}
+
+
+class Queue:
+    def __init__(self, backend=None, workers=constants.job_workers, clock=time.time):
+        self._backend = backend
+        self.workers = workers
+        self.clock = clock
+        self.processed = 0
+        self.retried = 0
+        self.failed = 0
+        self._threads = []
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+        # (read at, depth, oldest) of the backend, reused by stats()
+        self._backlog = None
+
+    @property
+    def backend(self):
+        if self._backend is None:
+            with self._lock:
+                if self._backend is None:
+                    path = os.getenv("jobs_db")
+                    if path:
+                        self._backend = SqliteBackend(path)
+                    elif os.getenv("jobs_backend") == "memory":
+                        self._backend = MemoryBackend()
+                    else:
+                        self._backend = DatastoreBackend()
+        return self._backend
+
+    def job(self, kind, args, job_id):
+        return _job(job_id, kind, args, self.clock())
+
+    # Queue the job kind for args, under job_id. Workers are started on the
+    # first enqueue, not at import.
+    def enqueue(self, kind, args, job_id):
+        added = self.backend.put(self.job(kind, args, job_id))
+        self.start()
+        self._wake.set()
+        return added
+
+    # Stage jobs from inside the transaction of the write that needs them. A
+    # transactional backend writes them in that transaction; pass the result
+    # to release() once it committed, which queues them with other backends.
+    def stage(self, jobs):
+        if self.backend.transactional:
+            self.backend.write(jobs)
+        return jobs
+
+    def release(self, jobs):
+        if not jobs:
+            return
+        if not self.backend.transactional:
+            for job in jobs:
+                self.backend.put(job)
+        self.start()
+        self._wake.set()
+
+    # Make failed jobs due again, returning how many
+    def retry_failed(self):
+        return self.backend.retry_failed(self.clock())
+
+    def start(self):
+        if self._threads or not self.workers:
+            return
+        with self._lock:
+            if self._threads:
+                return
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._work, name="jobs-%d" % i, daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    # Claim one batch of due jobs and run it, grouped by kind. Returns the
+    # number of jobs claimed.
+    def run_once(self, client):
+        jobs = self.backend.claim(constants.job_batch_size, self.clock(), constants.job_lease)
+        by_kind = OrderedDict()
+        for job in jobs:
+            by_kind.setdefault(job["kind"], []).append(job)
+        for kind, group in by_kind.items():
+            try:
+                HANDLERS[kind](client, [job["args"] for job in group])
+            except Exception:
+                for job in group:
+                    if job["attempts"] + 1 >= constants.job_max_attempts:
+                        self.backend.fail(job)
+                        self._count(failed=1)
+                    else:
+                        self.backend.retry(job, self.clock() + transactions.backoff(job["attempts"]))
+                        self._count(retried=1)
+                continue
+            for job in group:
+                self.backend.done(job, self.clock())
+            self._count(processed=len(group))
+        return len(jobs)
+
+    # Run jobs until none is due, e.g. from a maintenance command
+    def drain(self, client):
+        while self.run_once(client):
+            pass
+
+    def _count(self, processed=0, retried=0, failed=0):
+        with self._lock:
+            self.processed += processed
+            self.retried += retried
+            self.failed += failed
+
+    def _work(self):
+        while True:
+            try:
+                claimed = self.run_once(db.get_client())
+            except Exception:
+                claimed = 0
+            if not claimed:
+                self._wake.wait(constants.job_poll_interval)
+                self._wake.clear()
+
+    # The backend's depth and oldest job are read at most once per
+    # constants.job_stats_ttl, however often /metrics is fetched
+    def stats(self):
+        now = self.clock()
+        with self._lock:
+            backlog = self._backlog
+        if backlog is None or now - backlog[0] >= constants.job_stats_ttl:
+            backlog = (now, self.backend.depth(), self.backend.oldest())
+            with self._lock:
+                self._backlog = backlog
+        read_at, depth, oldest = backlog
+        with self._lock:
+            return {"depth": depth, "lag_seconds": now - oldest if oldest else 0.0,
+                    "processed": self.processed, "retried": self.retried, "failed": self.failed}
+
+
+queue = Queue()
+
+
+def enqueue(kind, args, job_id):
+    return queue.enqueue(kind, args, job_id)
+
+
+# Jobs that clear the carrier of the loads of the deleted boat_ids
+def detach_jobs(boat_ids):
+    return [queue.job("detach_loads", {"boat_id": boat_id}, "detach_loads:" + str(boat_id)) for boat_id in boat_ids]
+
+
+# The job that copies a renamed boat's name into its loads' carrier
+def carrier_name_jobs(boat_id):
+    return [queue.job("carrier_name", {"boat_id": boat_id}, "carrier_name:" + str(boat_id))]
+
+
+# Clear the carrier of every load whose boat no longer exists, e.g. after a
+# detach_loads job failed or, with a backend outside Datastore, was lost.
+# Returns the number of such boats and of loads detached.
+def repair_carriers(client):
+    carried = {}
+    for load in client.query(kind=constants.loads).fetch():
+        carrier = load.get("carrier")
+        if carrier:
+            carried.setdefault(int(carrier["id"]), []).append(load.key)
+    # boats are looked up in Datastore, a cached copy may outlive its boat
+    existing = set()
+    for chunk in batch.chunks([client.key(constants.boats, boat_id) for boat_id in carried]):
+        existing.update(boat.key.id for boat in client.get_multi(chunk))
+    missing = set(carried) - existing
+    load_keys = [key for boat_id in missing for key in carried[boat_id]]
+    detached = 0
+    for chunk in batch.chunks(load_keys):
+        for attempt in transactions.attempts(client):
+            with attempt:
+                loads = batch.detach_loads(client, chunk, missing)
+        cache.invalidate([load.key for load in loads])
+        detached += len(loads)
+    return {"boats missing": len(missing), "loads detached": detached}
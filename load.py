@@ -1,11 +1,50 @@
 from flask import Blueprint, request, Response
+from google.api_core import exceptions
 from google.cloud import datastore
 import json
+import aggregates
+import batch
+import cache
 import constants
-
-client = datastore.Client()
+import counter
+from db import client
+import etag
+import fieldsets
+import filters
+import pagination
+import parallel
+import responses
+import transactions
 
 bp = Blueprint('load', __name__, url_prefix='/loads')
+# the batch routes are not under /loads/ so they get their own blueprint
+batch_bp = Blueprint('load_batch', __name__)
+
+
+# Return an error message if content is not a complete load, else None
+def validate_load(content):
+    if not isinstance(content, dict) or len(content.items()) < 3:
+        return "The request object is missing at least one of the required attributes"
+    for attr in ("volume", "item", "creation_date"):
+        if attr not in content:
+            return "The request object is missing at least one of the required attributes"
+    return None
+
+
+# the boat carrying a load only changes through PUT and DELETE
+# /boats/<bid>/loads/<lid>, which check the boat's owner and keep its
+# aggregates
+READ_ONLY = ("carrier",)
+
+
+# Return an error message if content tries to set a read-only property, else None
+def validate_patch(content):
+    if not isinstance(content, dict) or len(content.items()) < 1:
+        return "The request object is empty"
+    fixed = [attr for attr in READ_ONLY if attr in content]
+    if fixed:
+        return ", ".join(fixed) + " can't be changed"
+    return None
 
 @bp.route('', methods=['POST','GET', 'PUT', 'PATCH', 'DELETE'])
 def loads_get_post():
@@ -21,42 +60,58 @@ def loads_get_post():
         content = request.get_json()
         new_load = datastore.entity.Entity(key=client.key(constants.loads))
         # if missing required attribute, 400 status code returned
-        if len(content.items()) < 3:
-            bad_request = {"Error" : "The request object is missing at least one of the required attributes"}
+        error = validate_load(content)
+        if error:
+            bad_request = {"Error" : error}
             return Response(json.dumps(bad_request), status= 400)
         new_load.update({"volume": content["volume"], "item": content["item"], "creation_date": content["creation_date"], "carrier": None})
-        client.put(new_load)
-        new_load["id"] = new_load.key.id
-        new_load["self"] = request.url_root + "loads/" + str(new_load["id"])
-        return Response(json.dumps(new_load), status= 201)
+        for attempt in transactions.attempts(client):
+            with attempt:
+                client.put(new_load)
+                counter.increment(client, counter.loads_counter(), 1)
+        cache.refresh(new_load)
+        return Response(responses.dumps(responses.load_view(new_load, request.url_root)), status= 201)
     elif request.method == 'GET':
         # if client does not accept response as JSON, 406 status returned
         if 'application/json' not in request.accept_mimetypes:
             not_json = {"Error" : "Accept header must accept response content type application/json"}
             return Response(json.dumps(not_json), status= 406)
-        query_count = client.query(kind=constants.loads)
-        total_items = len(list(query_count.fetch()))
+        try:
+            fields = fieldsets.parse(request, constants.loads)
+        except fieldsets.FieldsError as e:
+            bad_request = {"Error" : e.message}
+            return Response(json.dumps(bad_request), status= 400)
         query = client.query(kind=constants.loads)
-        q_limit = int(request.args.get('limit', '5'))
-        q_offset = int(request.args.get('offset', '0'))
-        g_iterator = query.fetch(limit= q_limit, offset=q_offset)
-        pages = g_iterator.pages
-        results = list(next(pages))
-        if g_iterator.next_page_token:
-            next_offset = q_offset + q_limit
-            next_url = request.base_url + "?limit=" + str(q_limit) + "&offset=" + str(next_offset)
-        else:
-            next_url = None
-        for e in results:
-            e["id"] = e.key.id
-            e["self"] = request.url_root + "loads/" + str(e["id"])
-            carrier = e["carrier"]
-            if carrier:
-                carrier["self"] = request.url_root + "boats/" + str(carrier["id"])
-        output = {"total_items": total_items, "loads": results}
+        try:
+            filtered = filters.apply(query, request)
+        except filters.FilterError as e:
+            bad_request = {"Error" : e.message}
+            return Response(json.dumps(bad_request), status= 400)
+        # read only the requested properties when an index allows it,
+        # filtered projections would need an index per filter combination
+        projected = fieldsets.projection("loads", fields)
+        if projected and not filtered:
+            query.projection = projected
+        # the counter only knows the total of all loads, and is read while
+        # the page is
+        count = None
+        if not filtered:
+            query_count = client.query(kind=constants.loads)
+            count = parallel.submit(counter.count, client, counter.loads_counter(), query_count)
+        try:
+            results, next_url = pagination.fetch_page(query, request)
+        except pagination.PaginationError as e:
+            bad_request = {"Error" : e.message}
+            return Response(json.dumps(bad_request), status= 400)
+        results = [responses.load_view(e, request.url_root) for e in results]
+        if fields:
+            results = [fieldsets.select(e, fields) for e in results]
+        output = {"loads": results}
+        if count is not None:
+            output["total_items"] = count.result()
         if next_url:
             output["next"] = next_url
-        return Response(json.dumps(output), status= 200)
+        return etag.conditional(request, Response(responses.dumps(output), status= 200))
     elif request.method == 'PUT':
         unsupported_method = {"Error" : "Method not supported"}
         return Response(json.dumps(unsupported_method), status= 405)
@@ -83,20 +138,30 @@ def loads_put_delete(id):
             return Response(json.dumps(not_json), status= 406)
         content = request.get_json()
         load_key = client.key(constants.loads, int(id))
-        load = client.get(key=load_key)
-        # if invalid id, 404 status code
-        if not load:
-            not_found = {"Error" : "No load with this load_id exists"}
-            return Response(json.dumps(not_found), status= 404)
-        # if missing required attributes, 400 status code returned
-        if len(content.items()) < 3:
-            bad_request = {"Error" : "The request object is missing at least one of the required attributes"}
-            return Response(json.dumps(bad_request), status= 400)
-        load.update({"volume": content["volume"], "item": content["item"], "creation_date": content["creation_date"]})
-        client.put(load)
-        load["id"] = load.key.id
-        load["self"] = request.url_root + "loads/" + str(load["id"])
-        return Response(json.dumps(load), status= 200)
+        # a carried load's volume is also part of its boat's total_volume, so
+        # the read and the writes share one transaction
+        for attempt in transactions.attempts(client):
+            with attempt:
+                load = client.get(load_key)
+                # if invalid id, 404 status code
+                if not load:
+                    not_found = {"Error" : "No load with this load_id exists"}
+                    return Response(json.dumps(not_found), status= 404)
+                if not etag.matches(request, load):
+                    return etag.precondition_failed_response()
+                # if missing required attributes, 400 status code returned
+                error = validate_load(content)
+                if error:
+                    bad_request = {"Error" : error}
+                    return Response(json.dumps(bad_request), status= 400)
+                old_volume, old_carrier = aggregates.volume(load), load.get("carrier")
+                load.update({"volume": content["volume"], "item": content["item"], "creation_date": content["creation_date"]})
+                client.put(load)
+                boats = aggregates.update_carrier(client, load, old_volume, old_carrier)
+        cache.refresh(load, *boats)
+        response = Response(responses.dumps(responses.load_view(load, request.url_root)), status= 200)
+        response.set_etag(etag.entity_etag(load))
+        return response
     elif request.method == 'PATCH':
         # if request is not JSON, 415 status returned
         if 'application/json' not in request.content_type:
@@ -108,37 +173,44 @@ def loads_put_delete(id):
             return Response(json.dumps(not_json), status= 406)
         content = request.get_json()
         load_key = client.key(constants.loads, int(id))
-        load = client.get(key=load_key)
-        # if invalid id, 404 status code
-        if not load:
-            not_found = {"Error" : "No load with this load_id exists"}
-            return Response(json.dumps(not_found), status= 404)
-        # if missing required attribute, 400 status code returned
-        if len(content.items()) < 1:
-            bad_request = {"Error" : "The request object is empty"}
-            return Response(json.dumps(bad_request), status= 400)
-        load.update(content)
-        client.put(load)
-        load["id"] = load.key.id
-        load["self"] = request.url_root + "loads/" + str(load["id"])
-        return Response(json.dumps(load), status= 200)
+        # a carried load's volume is also part of its boat's total_volume, so
+        # the read and the writes share one transaction
+        for attempt in transactions.attempts(client):
+            with attempt:
+                load = client.get(load_key)
+                # if invalid id, 404 status code
+                if not load:
+                    not_found = {"Error" : "No load with this load_id exists"}
+                    return Response(json.dumps(not_found), status= 404)
+                if not etag.matches(request, load):
+                    return etag.precondition_failed_response()
+                # if empty or setting the carrier, 400 status code returned
+                error = validate_patch(content)
+                if error:
+                    bad_request = {"Error" : error}
+                    return Response(json.dumps(bad_request), status= 400)
+                old_volume, old_carrier = aggregates.volume(load), load.get("carrier")
+                load.update(content)
+                client.put(load)
+                boats = aggregates.update_carrier(client, load, old_volume, old_carrier)
+        cache.refresh(load, *boats)
+        response = Response(responses.dumps(responses.load_view(load, request.url_root)), status= 200)
+        response.set_etag(etag.entity_etag(load))
+        return response
     elif request.method == 'DELETE':
         key = client.key(constants.loads, int(id))
-        load = client.get(key=key)
-        if not load:
-            not_found = {"Error" : "No load with this load_id exists"}
-            return Response(json.dumps(not_found), status= 404)
-        # check if load has a carrier, remove load from boat
-        if load["carrier"]:
-            carrier = load["carrier"]
-            boat_id = carrier["id"]
-            boat_key = client.key(constants.boats, int(boat_id))
-            boat = client.get(key=boat_key)
-            for l in boat["loads"]:
-                if l["id"] == int(id):
-                    boat["loads"].remove(l)
-                    client.put(boat)
-        client.delete(key)
+        # take the load off its carrier's aggregates in the same commit as the
+        # delete, going by the load as it is read in that transaction
+        for attempt in transactions.attempts(client):
+            with attempt:
+                load = client.get(key)
+                if not load:
+                    not_found = {"Error" : "No load with this load_id exists"}
+                    return Response(json.dumps(not_found), status= 404)
+                boats = batch.remove_from_carriers(client, [load])
+                client.delete(key)
+                counter.increment(client, counter.loads_counter(), -1)
+        cache.invalidate([key] + [b.key for b in boats])
         return ('',204)
     elif request.method == 'GET':
         # if client does not accept response as JSON, 406 status returned
@@ -146,16 +218,110 @@ def loads_put_delete(id):
             not_json = {"Error" : "Accept header must accept response content type application/json"}
             return Response(json.dumps(not_json), status= 406)
         load_key = client.key(constants.loads, int(id))
-        load = client.get(key=load_key)
+        load = cache.get(client, load_key)
         # if invalid id, 404 status code
         if not load:
             not_found = {"Error" : "No load with this load_id exists"}
             return Response(json.dumps(not_found), status= 404)
-        load["id"] = load.key.id
-        load["self"] = request.url_root + "loads/" + str(load["id"])
-        carrier = load["carrier"]
-        if carrier:
-            carrier["self"] = request.url_root + "boats/" + str(carrier["id"])
-        return Response(json.dumps(load), status= 200)
+        # the client's copy is still current, skip building the body
+        tag = etag.entity_etag(load)
+        if etag.not_modified(request, tag):
+            return etag.not_modified_response(tag)
+        response = Response(responses.dumps(responses.load_view(load, request.url_root)), status= 200)
+        response.set_etag(tag)
+        return response
     else:
-        return 'Method not recogonized'
\ No newline at end of file
+        return 'Method not recogonized'
+
+
+@batch_bp.route('/loads:batch', methods=['POST', 'GET', 'DELETE'])
+def loads_batch():
+    # if client does not accept response as JSON, 406 status returned
+    if 'application/json' not in request.accept_mimetypes:
+        not_json = {"Error" : "Accept header must accept response content type application/json"}
+        return Response(json.dumps(not_json), status= 406)
+    if request.method == 'POST':
+        # if request is not JSON, 415 status returned
+        if not request.content_type or 'application/json' not in request.content_type:
+            not_json = {"Error" : "Request must be content type application/json"}
+            return Response(json.dumps(not_json), status= 415)
+        content = request.get_json()
+        if not isinstance(content, list) or len(content) > constants.max_batch_items:
+            bad_request = {"Error" : "The request must be a list of at most " + str(constants.max_batch_items) + " loads"}
+            return Response(json.dumps(bad_request), status= 400)
+        results = [None] * len(content)
+        new_loads = []
+        for i, item in enumerate(content):
+            error = validate_load(item)
+            if error:
+                results[i] = {"status": 400, "Error": error}
+            else:
+                new_loads.append((i, item))
+        # ids for the whole batch are allocated in one call
+        keys = client.allocate_ids(client.key(constants.loads), len(new_loads)) if new_loads else []
+        entities = []
+        for key, (i, item) in zip(keys, new_loads):
+            new_load = datastore.entity.Entity(key=key)
+            new_load.update({"volume": item["volume"], "item": item["item"], "creation_date": item["creation_date"], "carrier": None})
+            entities.append((i, new_load))
+        for chunk in batch.chunks(entities, constants.transaction_batch_size):
+            # earlier chunks are already committed, so a chunk that still
+            # conflicts after its retries only fails its own items
+            try:
+                for attempt in transactions.attempts(client):
+                    with attempt:
+                        client.put_multi([e for i, e in chunk])
+                        counter.increment(client, counter.loads_counter(), len(chunk))
+            except exceptions.Conflict:
+                for i, new_load in chunk:
+                    results[i] = {"status": 409, "Error": "The request conflicted with concurrent changes, try again"}
+                continue
+            cache.refresh(*[e for i, e in chunk])
+            for i, new_load in chunk:
+                results[i] = {"status": 201, "load": responses.load_view(new_load, request.url_root)}
+        return Response(responses.dumps({"results": results}), status= 200)
+    try:
+        ids = batch.parse_ids(request)
+    except batch.BatchError as e:
+        bad_request = {"Error" : e.message}
+        return Response(json.dumps(bad_request), status= 400)
+    results = batch.id_results(ids)
+    found = {}
+    keys = [client.key(constants.loads, i) for i in set(ids) if i is not None]
+    for load in batch.get_multi(client, keys):
+        found[load.key.id] = load
+    if request.method == 'GET':
+        for i, load_id in enumerate(ids):
+            if load_id is None:
+                continue
+            load = found.get(load_id)
+            if not load:
+                results[i] = {"status": 404, "Error": "No load with this load_id exists"}
+                continue
+            results[i] = {"status": 200, "load": responses.load_view(load, request.url_root)}
+        return Response(responses.dumps({"results": results}), status= 200)
+    elif request.method == 'DELETE':
+        # loads are taken off their carriers' aggregates in the same commit
+        # as the delete, going by the loads as they are read in that
+        # transaction rather than the copies read above
+        for chunk in batch.chunks([load.key for load in found.values()], constants.transaction_batch_size):
+            for attempt in transactions.attempts(client):
+                with attempt:
+                    loads = client.get_multi(chunk)
+                    boats = batch.remove_from_carriers(client, loads)
+                    client.delete_multi([load.key for load in loads])
+                    if loads:
+                        counter.increment(client, counter.loads_counter(), -len(loads))
+            cache.invalidate(chunk + [b.key for b in boats])
+        for i, load_id in enumerate(ids):
+            if load_id is None:
+                continue
+            if load_id in found:
+                results[i] = {"status": 204, "id": load_id}
+                # a repeated id is only deleted once
+                del found[load_id]
+            else:
+                results[i] = {"status": 404, "Error": "No load with this load_id exists"}
+        return Response(responses.dumps({"results": results}), status= 200)
+    else:
+        return 'Method not recognized'
@@ -1,30 +1,50 @@
 from flask import Flask, request, Response, jsonify, redirect, session, render_template, url_for
 import boat
+import constants
+import export
 import load
-from google.cloud import datastore
+from google.api_core import exceptions
 import json
 import uuid
-import json
-from dotenv import load_dotenv
 import os
 from authlib.integrations.flask_client import OAuth
 from urllib.parse import urlencode, quote_plus
-from auth import verify_jwt, AuthError
+from werkzeug.middleware.proxy_fix import ProxyFix
+from auth import verify_jwt, AuthError, CLIENT_ID, DOMAIN
+from db import client
+import metrics
+import pagination
+import ratelimit
+import responses
+import sessions
+import users
 
 app = Flask(__name__)
-app.secret_key = str(uuid.uuid4())
+# take the client's address from the X-Forwarded-For entries of trusted
+# proxies, so rate limits apply per client rather than per proxy
+TRUSTED_PROXIES = int(os.getenv("trusted_proxies", constants.trusted_proxies))
+if TRUSTED_PROXIES:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXIES)
+# auth has already loaded .env
+# the secret signs session cookies, so every instance must share it; without
+# one, sessions only last as long as this instance
+app.secret_key = os.getenv("secret_key") or str(uuid.uuid4())
+app.session_interface = sessions.ServerSideSessionInterface()
 app.register_blueprint(boat.bp)
 app.register_blueprint(load.bp)
-client = datastore.Client()
-users = "users"
-load_dotenv()
-CLIENT_ID = os.getenv("client_id")
+app.register_blueprint(boat.batch_bp)
+app.register_blueprint(load.batch_bp)
+app.register_blueprint(export.bp)
+metrics.init_app(app)
+# registered after metrics so rejected requests are counted too
+ratelimit.init_app(app)
+# registered after metrics so its compression time is in Server-Timing
+responses.init_app(app)
 CLIENT_SECRET = os.getenv("client_secret")
-DOMAIN = 'cs493-clarkeab.us.auth0.com'
-
-ALGORITHMS = ["RS256"]
 
-oauth = OAuth(app)
+# registering before init_app defers building the Auth0 client, and with it
+# the fetch of the server metadata, until the first login
+oauth = OAuth()
 
 auth0 = oauth.register(
     'auth0',
@@ -38,6 +58,7 @@ auth0 = oauth.register(
     },
     server_metadata_url=f'https://{DOMAIN}/.well-known/openid-configuration'
 )
+oauth.init_app(app)
 
 @app.errorhandler(AuthError)
 def handle_auth_error(ex):
@@ -45,6 +66,14 @@ def handle_auth_error(ex):
     response.status_code = ex.status_code
     return response
 
+# a transaction that still conflicts after its retries
+@app.errorhandler(exceptions.Conflict)
+def handle_conflict(ex):
+    conflict = {"Error" : "The request conflicted with concurrent changes, try again"}
+    response = Response(json.dumps(conflict), status= 409)
+    response.headers["Retry-After"] = "1"
+    return response
+
 # auth0 login/callback/logout code adapted from https://auth0.com/docs/quickstart/webapp/python
 @app.route('/')
 def index():
@@ -53,19 +82,13 @@ def index():
 @app.route('/callback', methods=["GET", "POST"])
 def callback():
     token = oauth.auth0.authorize_access_token()
+    app.session_interface.regenerate(session)
     session["user"] = token
     userinfo = token.get("userinfo")
     sub = userinfo.get("sub")
     name = userinfo.get("name")
-    # check if user has been added to database
-    query = client.query(kind=users)
-    query.add_filter("sub", "=", sub)
-    results = list(query.fetch())
     # add new user
-    if len(results) < 1:
-        new_user = datastore.entity.Entity(key=client.key(users))
-        new_user.update({"sub": sub, "name": name})
-        client.put(new_user)
+    users.ensure(client, sub, name)
     return redirect("/")
 
 @app.route('/logout')
@@ -95,11 +118,16 @@ def get_users():
         if 'application/json' not in request.accept_mimetypes:
             not_json = {"Error" : "Accept header must accept response content type application/json"}
             return Response(json.dumps(not_json), status= 406)
-        query = client.query(kind=users)
-        results = list(query.fetch())
-        for e in results:
-            e["id"] = e.key.id
-        return Response(json.dumps(results), status= 200)
+        query = client.query(kind=constants.users)
+        try:
+            results, next_url = pagination.fetch_page(query, request)
+        except pagination.PaginationError as e:
+            bad_request = {"Error" : e.message}
+            return Response(json.dumps(bad_request), status= 400)
+        output = {"users": [responses.user_view(e) for e in results]}
+        if next_url:
+            output["next"] = next_url
+        return Response(responses.dumps(output), status= 200)
     else:
         return jsonify(error='Method not recognized')
 
@@ -0,0 +1,92 @@
+import aggregates
+import argparse
+import constants
+import counter
+import db
+import importer
+import jobs
+import migrations
+import sessions
+import sys
+
+# Maintenance commands, run with: python manage.py <command>
+
+
+def repair_counters(client, args):
+    totals = counter.repair(client)
+    for name in sorted(totals):
+        print(name, totals[name])
+
+
+def rebuild_aggregates(client, args):
+    print("boats", aggregates.rebuild(client))
+
+
+def migrate_loads(client, args):
+    for name, value in migrations.loads(client).items():
+        print(name, value)
+
+
+def migrate_users(client, args):
+    for name, value in migrations.users(client).items():
+        print(name, value)
+
+
+def purge_sessions(client, args):
+    print("sessions", sessions.purge(client))
+
+
+# Make failed jobs due again and run every due job
+def drain_jobs(client, args):
+    print("failed jobs retried", jobs.queue.retry_failed())
+    jobs.queue.drain(client)
+    stats = jobs.queue.stats()
+    print("jobs run", stats["processed"])
+    print("jobs failed", stats["failed"])
+
+
+def repair_carriers(client, args):
+    for name, value in jobs.repair_carriers(client).items():
+        print(name, value)
+
+
+# python manage.py import loads|boats FILE [--format csv|ndjson] [--owner SUB]
+#     [--workers N] [--checkpoint PATH]
+def import_entities(client, args):
+    if not args.kind or not args.file:
+        sys.exit("import needs a kind (loads or boats) and a file")
+    try:
+        totals = importer.run(client, args.kind, args.file, format=args.format, owner=args.owner,
+                              workers=args.workers, checkpoint=args.checkpoint)
+    except importer.ImporterError as e:
+        sys.exit(e.message)
+    for name in ("records", "imported", "invalid", "skipped", "failed", "seconds"):
+        print(name, totals[name])
+    # failed chunks are retried by running the same import again
+    if totals["failed"]:
+        sys.exit(1)
+
+
+commands = {
+    "drain-jobs": drain_jobs,
+    "import": import_entities,
+    "migrate-loads": migrate_loads,
+    "migrate-users": migrate_users,
+    "purge-sessions": purge_sessions,
+    "rebuild-aggregates": rebuild_aggregates,
+    "repair-carriers": repair_carriers,
+    "repair-counters": repair_counters,
+}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Marina maintenance commands")
+    parser.add_argument("command", choices=sorted(commands))
+    parser.add_argument("kind", nargs="?", choices=sorted(importer.KINDS), help="import: the kind to import")
+    parser.add_argument("file", nargs="?", help="import: CSV or NDJSON file of records")
+    parser.add_argument("--format", choices=["csv", "ndjson"], help="import: format of the file, by default from its extension")
+    parser.add_argument("--owner", help="import: owner of boats that have no owner column")
+    parser.add_argument("--workers", type=int, default=constants.import_workers, help="import: chunks written at once")
+    parser.add_argument("--checkpoint", help="import: checkpoint file, by default FILE.checkpoint")
+    args = parser.parse_args()
+    commands[args.command](db.get_client(), args)
@@ -0,0 +1,284 @@
+from flask import Response, g, has_app_context, request
+from contextlib import contextmanager
+import threading
+import time
+
+# Lightweight request instrumentation. Datastore calls made through an
+# InstrumentedClient, verify_jwt and JSON encoding add their time to the
+# current request; after_request folds that into per-route counters and
+# histograms once, sends a Server-Timing header, and /metrics serves it all in
+# the Prometheus text format.
+
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+RPC_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+STAGES = ("datastore", "auth", "json", "compress")
+
+_lock = threading.Lock()
+_requests = {}
+_rpcs = {}
+_histograms = {}
+_jwks = {"fetches": 0, "errors": 0}
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+
+def _observe(name, labels, value, buckets=BUCKETS):
+    key = (name, labels)
+    histogram = _histograms.get(key)
+    if histogram is None:
+        histogram = _histograms[key] = Histogram(buckets)
+    histogram.observe(value)
+
+
+def _current():
+    if not has_app_context():
+        return None
+    return g.get("_metrics")
+
+
+# Add seconds (and Datastore rpcs) spent in stage to the current request
+def record(stage, seconds, rpc=None):
+    current = _current()
+    if current is None:
+        return
+    # calls made in parallel for one request record from several threads
+    with current["lock"]:
+        current["timings"][stage] = current["timings"].get(stage, 0.0) + seconds
+        if rpc:
+            current["rpcs"][rpc] = current["rpcs"].get(rpc, 0) + 1
+
+
+@contextmanager
+def timer(stage, rpc=None):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(stage, time.perf_counter() - start, rpc)
+
+
+def observe_jwks_fetch(seconds, ok):
+    with _lock:
+        _jwks["fetches"] += 1
+        if not ok:
+            _jwks["errors"] += 1
+        _observe("jwks_fetch_duration_seconds", (), seconds)
+
+
+class InstrumentedIterator:
+    def __init__(self, iterator):
+        self._iterator = iterator
+
+    # every page is one RunQuery call
+    @property
+    def pages(self):
+        pages = self._iterator.pages
+        while True:
+            with timer("datastore", "RunQuery"):
+                page = next(pages, None)
+            if page is None:
+                return
+            yield page
+
+    def __iter__(self):
+        for page in self.pages:
+            yield from page
+
+    def __getattr__(self, name):
+        return getattr(self._iterator, name)
+
+
+class InstrumentedQuery:
+    def __init__(self, query):
+        object.__setattr__(self, "_query", query)
+
+    def fetch(self, *args, **kwargs):
+        return InstrumentedIterator(self._query.fetch(*args, **kwargs))
+
+    def __getattr__(self, name):
+        return getattr(self._query, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._query, name, value)
+
+
+class InstrumentedTransaction:
+    def __init__(self, transaction):
+        self._transaction = transaction
+
+    def __enter__(self):
+        with timer("datastore", "BeginTransaction"):
+            self._transaction.__enter__()
+        return self
+
+    def __exit__(self, *exc):
+        rpc = "Rollback" if exc[0] is not None else "Commit"
+        with timer("datastore", rpc):
+            return self._transaction.__exit__(*exc)
+
+    def __getattr__(self, name):
+        return getattr(self._transaction, name)
+
+
+# Wraps a datastore.Client, timing and counting the calls that reach Datastore
+class InstrumentedClient:
+    def __init__(self, client):
+        self._client = client
+
+    def _write_rpc(self):
+        # writes inside a transaction are sent with its commit
+        return "Commit" if self._client.current_batch is None else None
+
+    def get(self, *args, **kwargs):
+        with timer("datastore", "Lookup"):
+            return self._client.get(*args, **kwargs)
+
+    def get_multi(self, *args, **kwargs):
+        with timer("datastore", "Lookup"):
+            return self._client.get_multi(*args, **kwargs)
+
+    def put(self, *args, **kwargs):
+        with timer("datastore", self._write_rpc()):
+            return self._client.put(*args, **kwargs)
+
+    def put_multi(self, *args, **kwargs):
+        with timer("datastore", self._write_rpc()):
+            return self._client.put_multi(*args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        with timer("datastore", self._write_rpc()):
+            return self._client.delete(*args, **kwargs)
+
+    def delete_multi(self, *args, **kwargs):
+        with timer("datastore", self._write_rpc()):
+            return self._client.delete_multi(*args, **kwargs)
+
+    def allocate_ids(self, *args, **kwargs):
+        with timer("datastore", "AllocateIds"):
+            return self._client.allocate_ids(*args, **kwargs)
+
+    def query(self, *args, **kwargs):
+        return InstrumentedQuery(self._client.query(*args, **kwargs))
+
+    def transaction(self, *args, **kwargs):
+        return InstrumentedTransaction(self._client.transaction(*args, **kwargs))
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+
+def instrument(client):
+    return InstrumentedClient(client)
+
+
+def _before_request():
+    g._metrics = {"start": time.perf_counter(), "timings": {}, "rpcs": {}, "lock": threading.Lock()}
+
+
+def _after_request(response):
+    current = g.pop("_metrics", None)
+    if current is None:
+        return response
+    total = time.perf_counter() - current["start"]
+    timings = current["timings"]
+    rpcs = current["rpcs"]
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    labels = (("route", route), ("method", request.method))
+    with _lock:
+        status_labels = labels + (("status", str(response.status_code)),)
+        _requests[status_labels] = _requests.get(status_labels, 0) + 1
+        for rpc, count in rpcs.items():
+            rpc_labels = labels + (("rpc", rpc),)
+            _rpcs[rpc_labels] = _rpcs.get(rpc_labels, 0) + count
+        _observe("request_duration_seconds", labels, total)
+        _observe("datastore_rpcs_per_request", labels, sum(rpcs.values()), RPC_BUCKETS)
+        for stage in STAGES:
+            if stage in timings:
+                _observe("stage_duration_seconds", labels + (("stage", stage),), timings[stage])
+    entries = []
+    for stage in STAGES:
+        if stage in timings:
+            entry = "%s;dur=%.2f" % (stage, timings[stage] * 1000)
+            if stage == "datastore":
+                entry += ';desc="%d rpcs"' % sum(rpcs.values())
+            entries.append(entry)
+    entries.append("total;dur=%.2f" % (total * 1000))
+    response.headers["Server-Timing"] = ", ".join(entries)
+    return response
+
+
+def _format_labels(labels, extra=()):
+    labels = tuple(labels) + tuple(extra)
+    if not labels:
+        return ""
+    return "{" + ",".join('%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in labels) + "}"
+
+
+# Render all metrics in the Prometheus text exposition format
+def render(extra_gauges=None):
+    lines = []
+    with _lock:
+        lines.append("# TYPE marina_requests_total counter")
+        for labels, value in sorted(_requests.items()):
+            lines.append("marina_requests_total%s %d" % (_format_labels(labels), value))
+        lines.append("# TYPE marina_datastore_rpcs_total counter")
+        for labels, value in sorted(_rpcs.items()):
+            lines.append("marina_datastore_rpcs_total%s %d" % (_format_labels(labels), value))
+        lines.append("# TYPE marina_jwks_fetches_total counter")
+        lines.append("marina_jwks_fetches_total %d" % _jwks["fetches"])
+        lines.append("# TYPE marina_jwks_fetch_errors_total counter")
+        lines.append("marina_jwks_fetch_errors_total %d" % _jwks["errors"])
+        names = sorted(set(name for name, labels in _histograms))
+        for name in names:
+            lines.append("# TYPE marina_%s histogram" % name)
+            for (hist_name, labels), histogram in sorted(_histograms.items()):
+                if hist_name != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    cumulative += count
+                    lines.append("marina_%s_bucket%s %d" % (name, _format_labels(labels, (("le", repr(bound)),)), cumulative))
+                lines.append("marina_%s_bucket%s %d" % (name, _format_labels(labels, (("le", "+Inf"),)), histogram.count))
+                lines.append("marina_%s_sum%s %f" % (name, _format_labels(labels), histogram.sum))
+                lines.append("marina_%s_count%s %d" % (name, _format_labels(labels), histogram.count))
+    for name, value in sorted((extra_gauges or {}).items()):
+        lines.append("# TYPE marina_%s gauge" % name)
+        lines.append("marina_%s %s" % (name, value))
+    return "\n".join(lines) + "\n"
+
+
+def _gauges():
+    import auth
+    import cache
+    import jobs
+    import ratelimit
+    gauges = {}
+    for prefix, stats in (("token_cache", auth.token_cache.stats()), ("entity_cache", cache.entities.stats()),
+                          ("jobs", jobs.queue.stats()), ("ratelimit", ratelimit.limiter.stats())):
+        for name, value in stats.items():
+            gauges[prefix + "_" + name] = value
+    return gauges
+
+
+def metrics():
+    return Response(render(_gauges()), status= 200, mimetype="text/plain; version=0.0.4")
+
+
+def init_app(app):
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    app.add_url_rule('/metrics', 'metrics', metrics, methods=['GET'])
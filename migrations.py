@@ -0,0 +1,54 @@
+from google.cloud import datastore
+import aggregates
+import batch
+import constants
+
+# One-off data migrations, run through manage.py. Each can be run again
+# safely: entities that are already migrated are left as they are.
+
+
+# Move boat-load membership from the loads lists embedded in boats onto the
+# loads' carrier. A listed load without a carrier gets the boat as its
+# carrier, a load naming another carrier keeps it. The lists are then
+# dropped and the boat aggregates rebuilt from the loads.
+def loads(client):
+    boats = [boat for boat in client.query(kind=constants.boats).fetch() if "loads" in boat]
+    attached = 0
+    for chunk in batch.chunks(boats):
+        listed = {}
+        for boat in chunk:
+            for stub in boat["loads"]:
+                if stub:
+                    listed.setdefault(int(stub["id"]), boat)
+        keys = [client.key(constants.loads, load_id) for load_id in listed]
+        detached = [load for load in batch.get_multi(client, keys) if not load.get("carrier")]
+        for load in detached:
+            boat = listed[load.key.id]
+            load["carrier"] = {"id": boat.key.id, "name": boat["name"]}
+        for boat in chunk:
+            del boat["loads"]
+        batch.put_multi(client, detached + chunk)
+        attached += len(detached)
+    aggregates.rebuild(client)
+    return {"boats": len(boats), "loads attached": attached}
+
+
+# Re-key users by their sub. Users stored under a numeric id are copied to
+# the key named by their sub, unless it already exists, and removed; extra
+# users with the same sub, left by logins that raced, go with them.
+def users(client):
+    by_sub = {}
+    for user in client.query(kind=constants.users).fetch():
+        if user.key.name is None:
+            by_sub.setdefault(user["sub"], []).append(user)
+    rekeyed = 0
+    for sub, old in by_sub.items():
+        with client.transaction():
+            new_key = client.key(constants.users, sub)
+            if client.get(new_key) is None:
+                user = datastore.Entity(key=new_key)
+                user.update(old[0])
+                client.put(user)
+                rekeyed += 1
+            client.delete_multi([user.key for user in old])
+    return {"users re-keyed": rekeyed, "old users removed": sum(len(old) for old in by_sub.values())}
@@ -0,0 +1,48 @@
+from google.api_core.exceptions import BadRequest
+from urllib.parse import urlencode
+import binascii
+import constants
+
+
+class PaginationError(Exception):
+    def __init__(self, message):
+        self.message = message
+
+
+# Read the limit, cursor and offset paging arguments from the request
+def page_args(request):
+    try:
+        limit = int(request.args.get('limit', str(constants.default_limit)))
+        offset = int(request.args.get('offset', '0'))
+    except ValueError:
+        raise PaginationError("limit and offset must be integers")
+    if limit < 1 or limit > constants.max_limit:
+        raise PaginationError("limit must be between 1 and " + str(constants.max_limit))
+    if offset < 0:
+        raise PaginationError("offset must not be negative")
+    return limit, request.args.get('cursor'), offset
+
+
+# Fetch one page of query. Pages are addressed by opaque query cursors; offset
+# is only honoured when no cursor is given, for clients built against the old
+# offset links. Returns the page's entities and the url of the next page.
+def fetch_page(query, request):
+    q_limit, cursor, q_offset = page_args(request)
+    if cursor:
+        iterator = query.fetch(limit=q_limit, start_cursor=cursor)
+    else:
+        iterator = query.fetch(limit=q_limit, offset=q_offset)
+    try:
+        results = list(next(iterator.pages))
+    except (binascii.Error, BadRequest):
+        raise PaginationError("The cursor is not valid")
+    next_url = None
+    if iterator.next_page_token:
+        token = iterator.next_page_token
+        if isinstance(token, bytes):
+            token = token.decode("ascii")
+        args = request.args.to_dict()
+        args.pop('offset', None)
+        args.update({"limit": q_limit, "cursor": token})
+        next_url = request.base_url + "?" + urlencode(args)
+    return results, next_url
@@ -0,0 +1,54 @@
+from concurrent.futures import ThreadPoolExecutor, wait
+from flask import copy_current_request_context, g, has_request_context
+import functools
+import threading
+import constants
+
+# Run a request's independent I/O calls (token verification, lookups, count
+# and page queries) at the same time on a bounded thread pool, so the request
+# waits for the slowest call instead of the sum of them. Calls run with a copy
+# of the request context and add their timings to the request's metrics.
+# Transactions are per thread: reads that belong to a transaction must stay
+# on the thread that opened it.
+
+_pool = None
+_lock = threading.Lock()
+
+
+def _executor():
+    global _pool
+    if _pool is None:
+        with _lock:
+            if _pool is None:
+                _pool = ThreadPoolExecutor(max_workers=constants.parallel_workers, thread_name_prefix="parallel")
+    return _pool
+
+
+def _bind(fn):
+    if not has_request_context():
+        return fn
+    request_metrics = g.get("_metrics")
+
+    @copy_current_request_context
+    def bound():
+        if request_metrics is not None:
+            g._metrics = request_metrics
+        return fn()
+    return bound
+
+
+# Start fn(*args, **kwargs) on the pool, returning its Future
+def submit(fn, *args, **kwargs):
+    return _executor().submit(_bind(functools.partial(fn, *args, **kwargs)))
+
+
+# Run the zero-argument calls concurrently and return their results in order.
+# The first call runs on this thread. If calls raise, the exception of the
+# earliest one in the argument list is raised, after all of them finished.
+def run(*calls):
+    futures = [submit(call) for call in calls[1:]]
+    try:
+        first = calls[0]()
+    finally:
+        wait(futures)
+    return [first] + [future.result() for future in futures]
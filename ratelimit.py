@@ -0,0 +1,208 @@
+from collections import OrderedDict
+from flask import Response, g, request
+import json
+import math
+import os
+import sqlite3
+import threading
+import time
+import constants
+from auth import AuthError, verify_jwt
+
+# Admission control in front of every route. Each caller has a token bucket,
+# keyed by the sub of a valid JWT or, for requests without one, by the
+# client's address; a request takes its route's cost from the bucket and gets
+# a 429 with Retry-After when the bucket is short. Separately, at most
+# max_concurrent_requests requests run at once; requests beyond that are shed
+# with a 503 before they reach Datastore.
+#
+# Buckets live in memory by default, so each instance limits on its own. Set
+# ratelimit_db to a file path to keep them in SQLite instead, so every worker
+# process on a host shares them. ratelimit_rate=0 turns the buckets off.
+
+# App Engine's front end sets X-Appengine-User-Ip and drops one sent by the
+# client, so it is only trusted there
+ON_APP_ENGINE = bool(os.getenv("GAE_ENV"))
+
+RATE = float(os.getenv("ratelimit_rate", constants.ratelimit_rate))
+BURST = float(os.getenv("ratelimit_burst", constants.ratelimit_burst))
+MAX_CONCURRENT = int(os.getenv("max_concurrent_requests", constants.max_concurrent_requests))
+
+# tokens a request takes, by (method, route); other routes take 1
+COSTS = {
+    # a page of boats also reads the owner's count
+    ("GET", "/boats"): 3,
+    ("GET", "/loads"): 2,
+    ("GET", "/boats/<id>/loads"): 2,
+    ("POST", "/boats:batch"): 10,
+    ("GET", "/boats:batch"): 10,
+    ("DELETE", "/boats:batch"): 10,
+    ("POST", "/loads:batch"): 10,
+    ("GET", "/loads:batch"): 10,
+    ("DELETE", "/loads:batch"): 10,
+    ("GET", "/loads/export"): 20,
+    ("GET", "/boats/export"): 20,
+    ("GET", "/users/export"): 20,
+}
+
+# endpoints that are never limited, so the instance can still be observed
+# while it sheds load
+EXEMPT = ("metrics", "static")
+
+
+# Refill a bucket that held tokens at updated to now, and take cost from it.
+# Returns the new (tokens, updated) and the seconds until cost tokens would
+# have been available, 0 if they were taken.
+def _take(bucket, cost, rate, burst, now):
+    tokens, updated = bucket if bucket else (burst, now)
+    tokens = min(burst, tokens + max(0.0, now - updated) * rate)
+    # a request costing more than the burst is admitted with a full bucket
+    cost = min(cost, burst)
+    if tokens >= cost:
+        return (tokens - cost, now), 0.0
+    return (tokens, now), (cost - tokens) / rate
+
+
+# Buckets in an in-process LRU. Any object with the same take method can be
+# used instead.
+class MemoryBackend:
+    def __init__(self, maxsize=constants.ratelimit_buckets):
+        self.maxsize = maxsize
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, cost, rate, burst, now):
+        with self._lock:
+            bucket, wait = _take(self._buckets.get(key), cost, rate, burst, now)
+            self._buckets[key] = bucket
+            self._buckets.move_to_end(key)
+            # a bucket that was dropped starts out full again, which is
+            # what an idle caller's bucket would be anyway
+            while len(self._buckets) > self.maxsize:
+                self._buckets.popitem(last=False)
+            return wait
+
+
+# The same buckets in a SQLite file that the worker processes of one host
+# share
+class SqliteBackend:
+    def __init__(self, path):
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=5)
+        self._lock = threading.Lock()
+        self._db.execute("CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)")
+
+    def take(self, key, cost, rate, burst, now):
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                bucket = self._db.execute("SELECT tokens, updated FROM buckets WHERE key = ?", (key,)).fetchone()
+                bucket, wait = _take(bucket, cost, rate, burst, now)
+                self._db.execute("INSERT OR REPLACE INTO buckets VALUES (?, ?, ?)", (key,) + bucket)
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+            return wait
+
+
+class Limiter:
+    def __init__(self, backend=None, rate=RATE, burst=BURST, max_concurrent=MAX_CONCURRENT, clock=time.time):
+        self._backend = backend
+        self.rate = rate
+        self.burst = burst
+        self.max_concurrent = max_concurrent
+        self.clock = clock
+        self.limited = 0
+        self.shed = 0
+        self.active = 0
+        self._lock = threading.Lock()
+
+    @property
+    def backend(self):
+        if self._backend is None:
+            with self._lock:
+                if self._backend is None:
+                    path = os.getenv("ratelimit_db")
+                    self._backend = SqliteBackend(path) if path else MemoryBackend()
+        return self._backend
+
+    # Take cost tokens from key's bucket. Returns 0 if the request may run,
+    # otherwise the seconds until it could.
+    def admit(self, key, cost):
+        if self.rate <= 0:
+            return 0.0
+        wait = self.backend.take(key, cost, self.rate, self.burst, self.clock())
+        if wait:
+            with self._lock:
+                self.limited += 1
+        return wait
+
+    # Take one of the max_concurrent slots, False if all are taken
+    def enter(self):
+        with self._lock:
+            if self.max_concurrent and self.active >= self.max_concurrent:
+                self.shed += 1
+                return False
+            self.active += 1
+            return True
+
+    def leave(self):
+        with self._lock:
+            self.active -= 1
+
+    def stats(self):
+        with self._lock:
+            return {"limited": self.limited, "shed": self.shed, "active": self.active}
+
+
+limiter = Limiter()
+
+
+# The address of the client, not of the proxy in front of the app. Behind
+# trusted_proxies other proxies, ProxyFix has already put it in remote_addr.
+def client_address(request):
+    if ON_APP_ENGINE and request.headers.get("X-Appengine-User-Ip"):
+        return request.headers["X-Appengine-User-Ip"]
+    return str(request.remote_addr)
+
+
+# The bucket of the current request: its verified sub, else its address
+def identity(request):
+    if 'Authorization' in request.headers:
+        try:
+            return "sub:" + verify_jwt(request)["sub"]
+        except (AuthError, IndexError, KeyError):
+            pass
+    return "ip:" + client_address(request)
+
+
+def cost(request):
+    return COSTS.get((request.method, request.url_rule.rule), 1)
+
+
+def _before_request():
+    if request.url_rule is None or request.endpoint in EXEMPT:
+        return None
+    if not limiter.enter():
+        overloaded = {"Error" : "The server is handling too many requests, try again"}
+        response = Response(json.dumps(overloaded), status= 503)
+        response.headers["Retry-After"] = "1"
+        return response
+    g._ratelimit_slot = True
+    wait = limiter.admit(identity(request), cost(request))
+    if wait:
+        too_many = {"Error" : "Too many requests, try again later"}
+        response = Response(json.dumps(too_many), status= 429)
+        response.headers["Retry-After"] = str(max(1, math.ceil(wait)))
+        return response
+    return None
+
+
+def _teardown_request(exc):
+    if g.pop("_ratelimit_slot", False):
+        limiter.leave()
+
+
+def init_app(app):
+    app.before_request(_before_request)
+    app.teardown_request(_teardown_request)
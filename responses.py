@@ -0,0 +1,158 @@
+from flask import request
+import json
+import os
+import zlib
+import constants
+import etag
+import metrics
+
+# The response layer shared by the handlers. Bodies are serialized by one
+# pluggable encoder (orjson when it is installed, the standard json module
+# otherwise), entities get their id and self links in views that leave the
+# entity itself untouched, and after_request compresses bodies with gzip or
+# deflate for clients that accept it.
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _json(obj):
+    return json.dumps(obj).encode("utf-8")
+
+
+def _orjson(obj):
+    try:
+        return orjson.dumps(obj)
+    except TypeError:
+        # e.g. an integer beyond 64 bits, which json can still write
+        return _json(obj)
+
+
+# name: function from an object to the JSON body as bytes
+ENCODERS = {"json": _json}
+if orjson is not None:
+    ENCODERS["orjson"] = _orjson
+
+_encoder = None
+
+
+# Serialize bodies with encoder, a name from ENCODERS or a function
+def use_encoder(encoder):
+    global _encoder
+    _encoder = ENCODERS[encoder] if isinstance(encoder, str) else encoder
+
+
+def encoder():
+    if _encoder is None:
+        use_encoder(os.getenv("json_encoder") or ("orjson" if orjson is not None else "json"))
+    return _encoder
+
+
+def dumps(obj):
+    with metrics.timer("json"):
+        return encoder()(obj)
+
+
+# What a client sees of a boat: its properties plus id and self
+def boat_view(boat, url_root):
+    view = dict(boat)
+    view["id"] = boat.key.id
+    view["self"] = url_root + "boats/" + str(boat.key.id)
+    return view
+
+
+# What a client sees of a load: its properties plus id and self, and the
+# carrier's self when it is on a boat
+def load_view(load, url_root):
+    view = dict(load)
+    view["id"] = load.key.id
+    view["self"] = url_root + "loads/" + str(load.key.id)
+    carrier = load.get("carrier")
+    if carrier:
+        view["carrier"] = dict(carrier, self=url_root + "boats/" + str(carrier["id"]))
+    return view
+
+
+def user_view(user):
+    view = dict(user)
+    view["id"] = user.key.id_or_name
+    return view
+
+
+# wbits of each content coding zlib can write
+CODINGS = {"gzip": 31, "deflate": 15}
+
+
+# The coding to compress the current response with, or None
+def negotiate():
+    coding = request.accept_encodings.best_match(list(CODINGS))
+    if coding and request.accept_encodings[coding]:
+        return coding
+    return None
+
+
+def compress(data, coding, level=constants.compress_level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, CODINGS[coding])
+    return compressor.compress(data) + compressor.flush()
+
+
+# Compress a streamed body chunk by chunk, flushing after each so the client
+# receives every chunk without waiting for the end
+def compress_stream(chunks, coding, level=constants.compress_level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, CODINGS[coding])
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode("utf-8")
+            yield compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        yield compressor.flush()
+    finally:
+        # a client that went away closes this, and with it the body's own
+        # generator
+        if hasattr(chunks, "close"):
+            chunks.close()
+
+
+# A 304 repeats the tag the client sent, which names the coded body if it
+# got a compressed one
+def _not_modified(response):
+    tag, weak = response.get_etag()
+    for coding in CODINGS:
+        if tag and request.if_none_match.contains(etag.coded(tag, coding)):
+            response.set_etag(etag.coded(tag, coding), weak)
+    return response
+
+
+# Buffered bodies are compressed from constants.compress_min_size bytes up,
+# streamed ones always. A compressed body's ETag gets the coding as a suffix,
+# so it is not taken for the uncompressed body's.
+def _after_request(response):
+    if response.status_code == 304:
+        return _not_modified(response)
+    if (response.status_code < 200 or response.status_code == 204 or request.method == "HEAD"
+            or response.direct_passthrough or "Content-Encoding" in response.headers):
+        return response
+    response.vary.add("Accept-Encoding")
+    coding = negotiate()
+    if coding is None:
+        return response
+    if response.is_streamed:
+        response.response = compress_stream(response.response, coding)
+        response.headers.pop("Content-Length", None)
+    else:
+        data = response.get_data()
+        if len(data) < constants.compress_min_size:
+            return response
+        with metrics.timer("compress"):
+            response.set_data(compress(data, coding))
+    response.headers["Content-Encoding"] = coding
+    tag, weak = response.get_etag()
+    if tag:
+        response.set_etag(etag.coded(tag, coding), weak)
+    return response
+
+
+def init_app(app):
+    app.after_request(_after_request)
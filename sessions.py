@@ -0,0 +1,142 @@
+from flask.sessions import SessionInterface, SessionMixin
+from google.cloud import datastore
+from itsdangerous import BadSignature, Signer
+from werkzeug.datastructures import CallbackDict
+import datetime
+import json
+import os
+import secrets
+import batch
+import cache
+import constants
+import db
+
+# Server-side sessions. The browser only holds a signed session id; the
+# session data (the Auth0 token response after login) is kept by a backend
+# for constants.session_ttl seconds after it was last written. Sessions are
+# stored in Datastore by default so every instance sees them; set
+# session_backend=memory to keep them in an in-process LRU instead, e.g. for a
+# single local instance.
+
+
+class Session(CallbackDict, SessionMixin):
+    def __init__(self, initial=None, sid=None, new=False):
+        def on_update(self):
+            self.modified = True
+        CallbackDict.__init__(self, initial, on_update)
+        self.sid = sid
+        self.new = new
+        self.modified = False
+
+
+# Sessions in an in-process LRU, dropped once their TTL has passed
+class MemoryBackend:
+    def __init__(self, maxsize=constants.session_cache_size, ttl=constants.session_ttl):
+        self._entries = cache.MemoryBackend(maxsize, ttl)
+
+    def get(self, sid):
+        return self._entries.get(sid)
+
+    def set(self, sid, data):
+        self._entries.set(sid, data)
+
+    def delete(self, sid):
+        self._entries.delete(sid)
+
+
+# Sessions as Datastore entities keyed by session id. Expired sessions are
+# ignored when read and removed by `python manage.py purge-sessions`. Sessions
+# read or written by this instance are kept in process for a few seconds, so
+# a browser's burst of requests does not look its session up every time.
+class DatastoreBackend:
+    def __init__(self, ttl=constants.session_ttl, cache_size=constants.session_read_cache_size,
+                 cache_ttl=constants.session_read_cache_ttl):
+        self.ttl = ttl
+        self._recent = cache.MemoryBackend(cache_size, cache_ttl)
+
+    def get(self, sid):
+        entry = self._recent.get(sid)
+        if entry is None:
+            client = db.get_client()
+            entity = client.get(client.key(constants.sessions, sid))
+            if entity is None:
+                return None
+            entry = (entity["data"], entity["expires"])
+            self._recent.set(sid, entry)
+        data, expires = entry
+        if expires <= datetime.datetime.now(datetime.timezone.utc):
+            return None
+        return json.loads(data)
+
+    def set(self, sid, data):
+        client = db.get_client()
+        entity = datastore.Entity(key=client.key(constants.sessions, sid), exclude_from_indexes=("data",))
+        entity.update({"data": json.dumps(data),
+                       "expires": datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=self.ttl)})
+        client.put(entity)
+        self._recent.set(sid, (entity["data"], entity["expires"]))
+
+    def delete(self, sid):
+        client = db.get_client()
+        client.delete(client.key(constants.sessions, sid))
+        self._recent.delete(sid)
+
+
+# Delete the sessions in Datastore whose TTL has passed, returning how many
+def purge(client):
+    query = client.query(kind=constants.sessions)
+    query.add_filter("expires", "<=", datetime.datetime.now(datetime.timezone.utc))
+    query.keys_only()
+    keys = [e.key for e in query.fetch()]
+    batch.delete_multi(client, keys)
+    return len(keys)
+
+
+class ServerSideSessionInterface(SessionInterface):
+    def __init__(self, backend=None):
+        if backend is None:
+            backend = MemoryBackend() if os.getenv("session_backend") == "memory" else DatastoreBackend()
+        self.backend = backend
+
+    def _signer(self, app):
+        return Signer(app.secret_key, salt="marina-session")
+
+    # Give session a new id, e.g. after login, so an id handed out before
+    # the user authenticated can't be used to ride on their login
+    def regenerate(self, session):
+        if not session.new:
+            self.backend.delete(session.sid)
+        session.sid = secrets.token_urlsafe(32)
+        session.new = True
+        session.modified = True
+
+    def open_session(self, app, request):
+        cookie = request.cookies.get(self.get_cookie_name(app))
+        if cookie:
+            try:
+                sid = self._signer(app).unsign(cookie).decode("ascii")
+            except BadSignature:
+                sid = None
+            data = self.backend.get(sid) if sid else None
+            if data is not None:
+                return Session(data, sid=sid)
+        return Session(sid=secrets.token_urlsafe(32), new=True)
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        if not session:
+            # a cleared session is removed from the store and the browser
+            if session.modified and not session.new:
+                self.backend.delete(session.sid)
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+        # only a changed session is written, unchanged ones keep their cookie
+        if not session.modified:
+            return
+        self.backend.set(session.sid, dict(session))
+        response.set_cookie(name, self._signer(app).sign(session.sid).decode("ascii"),
+                            max_age=constants.session_ttl, httponly=self.get_cookie_httponly(app),
+                            domain=domain, path=path, secure=self.get_cookie_secure(app),
+                            samesite=self.get_cookie_samesite(app))
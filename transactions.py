@@ -0,0 +1,57 @@
+import random
+import time
+from google.api_core import exceptions
+import constants
+
+# Retry transactions that fail because of contention. Datastore transactions
+# are optimistic: a commit fails with Aborted (a Conflict) when another commit
+# changed an entity the transaction read. Wrap the transaction body in a loop:
+#
+#   for attempt in transactions.attempts(client):
+#       with attempt:
+#           ...reads and writes...
+#
+# A failed attempt is rolled back and retried after a jittered backoff; the
+# loop ends once an attempt commits, or a non-contention error is raised. A
+# return inside the with block commits and returns as usual. When every
+# attempt conflicts the last Conflict is raised.
+
+
+class Attempt:
+    def __init__(self, client, last):
+        self._client = client
+        self._last = last
+        self.committed = False
+
+    def __enter__(self):
+        self._transaction = self._client.transaction()
+        self._transaction.__enter__()
+        return self._transaction
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            self._transaction.__exit__(exc_type, exc, tb)
+        except exceptions.Conflict:
+            # the commit failed
+            if self._last:
+                raise
+            return True
+        if exc_type is not None:
+            # a read inside the transaction can fail on contention as well
+            return issubclass(exc_type, exceptions.Conflict) and not self._last
+        self.committed = True
+        return False
+
+
+# Seconds to wait before retry number n (0 is the first retry), full jitter
+def backoff(n):
+    return random.uniform(0, min(constants.transaction_backoff_cap, constants.transaction_backoff * 2 ** n))
+
+
+def attempts(client, tries=constants.transaction_attempts):
+    for n in range(tries):
+        attempt = Attempt(client, n == tries - 1)
+        yield attempt
+        if attempt.committed:
+            return
+        time.sleep(backoff(n))
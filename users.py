@@ -0,0 +1,29 @@
+from google.cloud import datastore
+import cache
+import constants
+
+# Users are keyed by their Auth0 sub, so the login callback can check for a
+# user with one key lookup instead of a query. Subs known to exist are
+# remembered in process, which makes repeat logins free of Datastore calls.
+
+known = cache.MemoryBackend(constants.known_users_size, constants.known_users_ttl)
+
+
+def key(client, sub):
+    return client.key(constants.users, sub)
+
+
+# Add the user for sub unless it exists. Returns True if it was added.
+def ensure(client, sub, name):
+    if known.get(sub):
+        return False
+    added = False
+    # insert if absent, so two logins racing for a new user add it once
+    with client.transaction():
+        if client.get(key(client, sub)) is None:
+            user = datastore.Entity(key=key(client, sub))
+            user.update({"sub": sub, "name": name})
+            client.put(user)
+            added = True
+    known.set(sub, True)
+    return added